@@ -0,0 +1,134 @@
+"""
+Admission control for one worker process (see `middleware.AdmissionMiddleware`).
+
+Requests are sorted into route classes:
+
+- "auth" -- registering and logging in (bcrypt makes these the slowest),
+- "write" -- every other POST, and review deletes,
+- "read" -- everything else (book pages and their snapshots, dashboards, static files).
+
+A request runs only while its class is under its own limit
+(`settings.ADMISSION_LIMITS`) and the process is under
+`settings.ADMISSION_MAX_IN_FLIGHT`. Otherwise it waits, until its queue
+deadline (`settings.ADMISSION_QUEUE_DEADLINE` seconds after it reached the
+front server, if that sent `X-Request-Start`, else after it reached us). A
+request that can't start in time -- or finds `settings.ADMISSION_MAX_WAITING`
+requests of its class already waiting -- is shed with a fast 503. So is a
+request that is already past its deadline when it arrives (it sat too long in
+the front server's or the kernel's queue), whether or not there is room.
+
+Reads come first: every waiting read holds back one slot that auth and write
+requests may not take, so a pile-up of logins or writes can delay reads by at
+most one request's duration, never starve them.
+
+The limits are per process, so they only shape traffic in processes that
+serve several requests at once (threaded workers). `serve_prefork` workers
+take one request at a time -- there, concurrency is `--workers`, and only the
+up-front deadline check applies.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+
+CLASSES = ("auth", "write", "read")
+AUTH_PATHS = ("/", "/login") # POSTs here register or log in
+WRITE_PREFIXES = ("/delete/",) # GETs that write
+
+
+def route_class(request):
+    """Returns "auth", "write" or "read" for a request, from its method and path only (before any view runs)."""
+
+    if request.method in ("GET", "HEAD", "OPTIONS"):
+        return "write" if request.path.startswith(WRITE_PREFIXES) else "read"
+    return "auth" if request.path in AUTH_PATHS else "write"
+
+
+def arrival_time(request):
+    """
+    When the request reached the front server (`X-Request-Start: t=<seconds>`,
+    e.g. nginx `"t=${msec}"`), or now if that header is missing or unreadable.
+    """
+
+    now = time.time()
+    header = request.META.get("HTTP_X_REQUEST_START", "")
+    try:
+        started = float(header[2:] if header.startswith("t=") else header)
+    except ValueError:
+        return now
+    return min(started, now) # never trust a clock ahead of ours
+
+
+class Gate(object):
+    """
+    Counts in-flight and waiting requests per route class and decides who may run.
+
+    Parameters:
+    - `max_in_flight` - Requests allowed to run at once in this process.
+    - `limits` - Dictionary of route class -> requests of that class allowed at once.
+    - `max_waiting` - Requests of one class allowed to wait before more are shed immediately.
+    """
+
+    def __init__(self, max_in_flight, limits, max_waiting):
+        self.max_in_flight = max_in_flight
+        self.limits = dict(limits)
+        self.max_waiting = max_waiting
+        self.in_flight = dict((name, 0) for name in CLASSES)
+        self.waiting = dict((name, 0) for name in CLASSES)
+        self._condition = threading.Condition()
+
+    def _has_room(self, route):
+        if self.in_flight[route] >= self.limits.get(route, self.max_in_flight):
+            return False
+        capacity = self.max_in_flight
+        if route != "read":
+            capacity -= self.waiting["read"] # waiting reads go first
+        return sum(self.in_flight.values()) < capacity
+
+    def enter(self, route, deadline):
+        """
+        Waits for a slot until `deadline` (a `time.time()` value).
+
+        Returns None once admitted (call `leave()` afterwards), or the reason
+        the request was shed: "queue_full" or "deadline".
+        """
+
+        if time.time() >= deadline:
+            return "deadline" # waited too long before reaching us; the client has likely given up
+        with self._condition:
+            if not self._has_room(route):
+                if self.waiting[route] >= self.max_waiting:
+                    return "queue_full"
+                self.waiting[route] += 1
+                try:
+                    while not self._has_room(route):
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return "deadline"
+                        self._condition.wait(remaining)
+                finally:
+                    self.waiting[route] -= 1
+                    self._condition.notify_all() # one fewer waiting read may free a slot for others
+            self.in_flight[route] += 1
+            return None
+
+    def leave(self, route):
+        with self._condition:
+            self.in_flight[route] -= 1
+            self._condition.notify_all()
+
+
+_gate = None
+_gate_lock = threading.Lock()
+
+
+def gate():
+    """Returns this process's `Gate`, built from settings on first use."""
+
+    global _gate
+    if _gate is None:
+        with _gate_lock:
+            if _gate is None:
+                _gate = Gate(settings.ADMISSION_MAX_IN_FLIGHT, settings.ADMISSION_LIMITS, settings.ADMISSION_MAX_WAITING)
+    return _gate
@@ -1,7 +1,21 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+from django.contrib.staticfiles.apps import StaticFilesConfig as BaseStaticFilesConfig
 
 
 class SecretsConfig(AppConfig):
     name = 'reviewer'
+
+
+class StaticFilesConfig(BaseStaticFilesConfig):
+    """
+    `django.contrib.staticfiles` with a longer ignore list, so `collectstatic` does
+    not publish font-awesome's less/scss sources, prebuilt min file, readme, or
+    the font formats `storage.subset_font_awesome()` strips out of the CSS.
+    """
+
+    ignore_patterns = BaseStaticFilesConfig.ignore_patterns + [
+        'less', 'scss', 'HELP-US-OUT.txt', 'font-awesome.min.css',
+        '*.eot', '*.ttf', '*.otf', 'fontawesome-webfont.svg',
+    ]
@@ -0,0 +1,108 @@
+"""
+Hot/cold partitioning of reviews.
+
+Reviews older than a cutoff are moved, in batches, from `Review` (hot) to
+`ArchivedReview` (cold) by the `archive_reviews` management command. Both
+tables share a schema and review ids, so a review keeps its id when it moves.
+
+Because only reviews older than the cutoff are ever moved, every hot review is
+newer than every cold one. A newest-first listing is therefore the hot rows
+followed by the cold rows, and `reviews_page()` only queries the cold table
+once a reader pages past the hot ones. Aggregates are unaffected by a move:
+`BookScore` counters are not touched (the review still exists), and the offline
+jobs that scan every review read both tables through `iter_all_reviews()`.
+"""
+
+from datetime import timedelta
+from itertools import chain
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from models import Book, Review, ArchivedReview # gives us access to models
+
+PAGE_SIZE = 20 # Reviews shown per page on book pages
+BATCH_SIZE = 500 # Reviews moved per transaction
+DEFAULT_MONTHS = 12 # Reviews older than this are archived
+FIELDS = ("id", "description", "user_id", "book_id", "rating", "created_at", "updated_at")
+
+
+def cutoff(months=DEFAULT_MONTHS, now=None):
+    """Returns the creation time before which reviews are archived (months counted as 30 days)."""
+
+    return (now or timezone.now()) - timedelta(days=30 * months)
+
+
+def archive_reviews(before, batch_size=BATCH_SIZE):
+    """
+    Moves reviews created before `before` to `ArchivedReview`, oldest first.
+
+    Each batch is copied and deleted in one transaction, so a review is never
+    in both tables or in neither, and an interrupted run can simply be rerun.
+
+    Returns the number of reviews moved.
+    """
+
+    moved = 0
+    while True:
+        with transaction.atomic():
+            rows = list(Review.objects.filter(created_at__lt=before).order_by("created_at", "id").values_list(*FIELDS)[:batch_size])
+            if not rows:
+                return moved
+            ArchivedReview.objects.bulk_create([ArchivedReview(**dict(zip(FIELDS, row))) for row in rows])
+            Review.objects.filter(id__in=[row[0] for row in rows]).delete()
+        moved += len(rows)
+
+
+def reviews_page(page=1, per_page=PAGE_SIZE, **filters):
+    """
+    Returns one page of reviews, newest first, across both partitions.
+
+    Parameters:
+    - `page` - 1-based page number.
+    - `per_page` - Reviews per page.
+    - `**filters` - Lookups applied to both tables (e.g. `book_id=3`).
+
+    Returns `(reviews, has_next)`; reviews come with their `user` loaded.
+    """
+
+    start = (page - 1) * per_page
+    wanted = per_page + 1 # one extra row tells whether there is a next page
+    hot = list(Review.objects.filter(**filters).select_related("user").order_by("-created_at", "-id")[start:start + wanted])
+    rows = hot
+    if len(hot) < wanted:
+        # Paged past the hot rows -- continue into the archive:
+        hot_total = start + len(hot) if hot or start == 0 else Review.objects.filter(**filters).count()
+        cold_start = max(start - hot_total, 0)
+        cold = ArchivedReview.objects.filter(**filters).select_related("user").order_by("-created_at", "-id")[cold_start:cold_start + wanted - len(hot)]
+        rows = hot + list(cold)
+    return rows[:per_page], len(rows) > per_page
+
+
+def count_reviews(**filters):
+    """Counts reviews matching `filters` in both partitions."""
+
+    return Review.objects.filter(**filters).count() + ArchivedReview.objects.filter(**filters).count()
+
+
+def reviewed_books(**filters):
+    """Returns the books with a review matching `filters` in either partition (two subqueries, one query)."""
+
+    hot = Review.objects.filter(**filters).values("book_id")
+    cold = ArchivedReview.objects.filter(**filters).values("book_id")
+    return Book.objects.filter(Q(id__in=hot) | Q(id__in=cold))
+
+
+def iter_all_reviews(*fields):
+    """
+    Streams `values_list(*fields)` rows of every review, hot then archived.
+
+    For offline jobs and exports that must see the whole history (recommendations,
+    leaderboard rebuilds, reports); request handlers should use `reviews_page()`.
+    """
+
+    return chain(
+        Review.objects.values_list(*fields).order_by().iterator(),
+        ArchivedReview.objects.values_list(*fields).order_by().iterator(),
+    )
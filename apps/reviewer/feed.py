@@ -0,0 +1,129 @@
+"""
+Personal feeds of reviews by followed reviewers.
+
+Fan-out on write: saving a review queues a `fan_out_review` job (see
+`ReviewManager._save_review()`), and `fan_out()` copies the review into a
+`FeedEntry` row per follower with batched bulk inserts, off the request path.
+Reading a feed (`read()`) is then one range scan of the (`owner`, `created_at`)
+index, whatever the number of followed reviewers.
+
+Fan-out on read: a reviewer with `PULL_FOLLOWERS` or more followers would cost
+that many inserts per review, so they are flagged `User.feed_pull` and skipped
+by the fan-out; `read()` pulls their latest reviews at read time and merges them in.
+
+Feeds are capped: once an owner has more than `FEED_SIZE + TRIM_SLACK`
+entries, all but the newest `FEED_SIZE` are deleted (the slack keeps that to
+one trim every few dozen reviews rather than one per review).
+"""
+
+from itertools import chain
+
+from django.db import transaction
+from django.db.models import Count
+
+from models import User, Review, Follow, FeedEntry # gives us access to models
+from . import pkcache # cached lookups by primary key
+
+FEED_SIZE = 50 # Entries kept per feed
+TRIM_SLACK = 25 # Entries a feed may grow past `FEED_SIZE` before it is trimmed
+PULL_FOLLOWERS = 1000 # Followers at which a reviewer switches to fan-out on read
+INSERT_BATCH_SIZE = 500 # Rows per bulk insert (and per `IN (...)` list, under SQLite's variable limit)
+
+
+def _chunks(items, size=INSERT_BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def pull_reviewer_ids(reviewer_ids):
+    """
+    Returns which of `reviewer_ids` are (or now become) fan-out-on-read reviewers.
+
+    Reviewers who reached `PULL_FOLLOWERS` followers are flagged `feed_pull`
+    here; the flag is never cleared automatically.
+    """
+
+    pull = set(User.objects.filter(id__in=reviewer_ids, feed_pull=True).values_list("id", flat=True))
+    counts = Follow.objects.filter(followee_id__in=set(reviewer_ids) - pull).values("followee_id").annotate(followers=Count("id")).filter(followers__gte=PULL_FOLLOWERS)
+    crossed = [row["followee_id"] for row in counts]
+    if crossed:
+        User.objects.filter(id__in=crossed).update(feed_pull=True)
+        pkcache.bump(User) # `update()` sends no signals
+    return pull | set(crossed)
+
+
+def fan_out(review_ids):
+    """
+    Copies new reviews into their reviewers' followers' feeds.
+
+    Reviews deleted before the job ran are skipped, as are follows undone
+    since, and followers that already have an entry (e.g. from a follow
+    backfill) don't get a second one, so a retried job is harmless.
+
+    Returns the number of entries written.
+    """
+
+    reviews = list(Review.objects.filter(id__in=review_ids).values_list("id", "user_id", "created_at"))
+    pull = pull_reviewer_ids([user_id for review_id, user_id, created_at in reviews])
+    written, owners = 0, set()
+    for review_id, user_id, created_at in reviews:
+        if user_id in pull:
+            continue
+        follower_ids = list(Follow.objects.filter(followee_id=user_id).values_list("follower_id", flat=True))
+        for chunk in _chunks(follower_ids):
+            with transaction.atomic():
+                # Lock the chunk's follows again, so an `unfollow()` since is seen, and a later one waits and deletes what we add:
+                following = set(Follow.objects.select_for_update().filter(followee_id=user_id, follower_id__in=chunk).values_list("follower_id", flat=True))
+                existing = set(FeedEntry.objects.filter(review_id=review_id, owner_id__in=chunk).values_list("owner_id", flat=True))
+                rows = [FeedEntry(owner_id=owner_id, review_id=review_id, created_at=created_at) for owner_id in chunk if owner_id in following and owner_id not in existing]
+                FeedEntry.objects.bulk_create(rows)
+            written += len(rows)
+        owners.update(follower_ids)
+    trim(list(owners))
+    return written
+
+
+def backfill(follower_id, followee_id):
+    """
+    Copies the followee's newest reviews into a new follower's feed (skipped
+    for fan-out-on-read reviewers, and if they unfollowed before the job ran).
+    """
+
+    if followee_id in pull_reviewer_ids([followee_id]):
+        return 0
+    with transaction.atomic():
+        # Lock the follow, so an `unfollow()` waits for us and then deletes what we add:
+        if not list(Follow.objects.select_for_update().filter(follower_id=follower_id, followee_id=followee_id).values_list("id", flat=True)):
+            return 0
+        reviews = Review.objects.filter(user_id=followee_id).order_by("-created_at").values_list("id", "created_at")[:FEED_SIZE]
+        existing = set(FeedEntry.objects.filter(owner_id=follower_id, review__user_id=followee_id).values_list("review_id", flat=True))
+        rows = [FeedEntry(owner_id=follower_id, review_id=review_id, created_at=created_at) for review_id, created_at in reviews if review_id not in existing]
+        FeedEntry.objects.bulk_create(rows)
+    trim([follower_id])
+    return len(rows)
+
+
+def trim(owner_ids):
+    """Cuts the feeds of `owner_ids` that outgrew `FEED_SIZE + TRIM_SLACK` back to the newest `FEED_SIZE` entries."""
+
+    for chunk in _chunks(owner_ids):
+        oversized = FeedEntry.objects.filter(owner_id__in=chunk).values("owner_id").annotate(entries=Count("id")).filter(entries__gt=FEED_SIZE + TRIM_SLACK)
+        for owner_id in [row["owner_id"] for row in oversized]:
+            keep = list(FeedEntry.objects.filter(owner_id=owner_id).order_by("-created_at", "-id").values_list("id", flat=True)[:FEED_SIZE])
+            FeedEntry.objects.filter(owner_id=owner_id).exclude(id__in=keep).delete()
+
+
+def read(user_id, limit=FEED_SIZE):
+    """
+    Returns the newest `limit` reviews by reviewers `user_id` follows, newest first.
+
+    One range scan over the user's feed entries, plus the latest reviews of any
+    followed fan-out-on-read reviewers. Reviews come with `user` and `book` loaded.
+    """
+
+    entries = FeedEntry.objects.filter(owner_id=user_id).select_related("review__user", "review__book").order_by("-created_at", "-id")[:limit]
+    pull_ids = Follow.objects.filter(follower_id=user_id, followee__feed_pull=True).values("followee_id")
+    pulled = Review.objects.filter(user_id__in=pull_ids).select_related("user", "book").order_by("-created_at")[:limit]
+    # A reviewer who switched to fan-out on read may still have entries -- keep one copy of each review:
+    reviews = dict((review.id, review) for review in chain((entry.review for entry in entries), pulled))
+    return sorted(reviews.values(), key=lambda review: (review.created_at, review.id), reverse=True)[:limit]
@@ -1,7 +1,14 @@
 """Helper module for gathering Dashboard or other Show data."""
 
-from models import User, Author, Book, Review # gives us access to all models
+from models import User, Author, Book, Review, BookNeighbor # gives us access to all models
 from django.db.models import Count
+from . import leaderboard # trending and top rated books
+from . import archive # hot/cold review partitions
+from . import feed # followers' review feeds
+from . import singleflight # coalesced cache refreshes
+
+BOOK_PAGE_TTL = 60 # Seconds a page of a book's reviews stays fresh in the cache (review writes drop it at once)
+DASHBOARD_TTL = 15 # Seconds the dashboard's shared lists stay fresh in the cache (review writes drop them at once)
 
 def create_authors():
     """Creates a few authors for initial add review page if there aren't any."""
@@ -46,6 +53,45 @@ def make_stars(reviews_list):
             review.empty.append(y)
 
 
+def book_page_data(book_id, page):
+    """
+    Returns the part of a logged-in book page that is the same for everyone:
+    `book`, `all_reviews` (with stars), `has_next` and `recommended_books`.
+
+    Cached through `singleflight`, keyed with the book's generation, which
+    `ReviewManager` bumps whenever one of its reviews is added or deleted.
+    """
+
+    def compute():
+        reviews, has_next = archive.reviews_page(page, book_id=book_id)
+        make_stars(reviews)
+        return {
+            "book": Book.objects.get(id=book_id),
+            "all_reviews": reviews,
+            "has_next": has_next,
+            "recommended_books": list(BookNeighbor.objects.filter(book__id=book_id).select_related("neighbor")), # precomputed by `build_recommendations`
+        }
+
+    key = "{}:{}:{}".format(int(book_id), singleflight.generation("book:{}".format(int(book_id))), page)
+    return singleflight.fetch("book_page", key, compute, BOOK_PAGE_TTL)
+
+def dashboard_lists():
+    """
+    Returns the dashboard's lists that are the same for everyone (latest
+    reviews, reviewed books), cached through `singleflight` and keyed with the
+    "dashboard" generation, which `ReviewManager` bumps on every review write.
+    """
+
+    def compute():
+        recent_reviews = list(Review.objects.select_related("user", "book").order_by("-created_at")[:3])
+        make_stars(recent_reviews)
+        return {
+            "3_recent_reviews": recent_reviews, # Gets latest 3 reviews
+            "all_books": list(archive.reviewed_books()), # Gets all distinct books with a review (archived ones too)
+        }
+
+    return singleflight.fetch("dashboard", "lists:{}".format(singleflight.generation("dashboard")), compute, DASHBOARD_TTL)
+
 def populate_dashboard_data(id):
     """
     Create dictionary for Dashboard Template.
@@ -63,12 +109,14 @@ def populate_dashboard_data(id):
     # Prepare data for Dashboard by running functions above, which collect the data we need:
     dashboard_data = {
         "current_user": User.objects.get(id=id), # Gets current session user
-        "3_recent_reviews": Review.objects.all().order_by("-created_at")[:3], # Gets latest 3 reviews
-        "all_books": Book.objects.filter(review__gte=1).distinct(), # Gets all distinct books with a review
+        "feed_reviews": feed.read(id, limit=10), # Gets latest reviews by reviewers the user follows
+        "trending_books": leaderboard.trending(), # Gets books with the most recent review activity
+        "top_rated_books": leaderboard.top_rated(), # Gets books with the best Bayesian average rating
     }
+    dashboard_data.update(dashboard_lists()) # latest 3 reviews and all reviewed books, shared by every user
 
-    # Create star rating for top 3 reviews:
-    make_stars(dashboard_data["3_recent_reviews"])
+    # Create star rating for feed reviews:
+    make_stars(dashboard_data["feed_reviews"])
 
     # Send back dashboard data which contains most recent and popular secrets with like counts, and the logged in user:
     return dashboard_data
@@ -0,0 +1,158 @@
+"""
+Local background job queue backed by the `Job` table.
+
+Request handlers queue jobs with `Job.objects.enqueue()` inside the same
+transaction as their write (outbox pattern) and return as soon as that is
+committed. The `run_workers` management command then claims and runs them:
+
+- Jobs of the same kind are claimed and handed to their handler in batches.
+- Claims are leases (`locked_until`), so jobs held by a crashed worker are retried.
+- Failed batches are retried with exponential backoff up to `MAX_ATTEMPTS`.
+- A batch's database writes commit together with the deletion of its jobs, so
+  a retried batch never applies anything twice.
+- Waiting jobs sharing a `dedupe_key` are collapsed into one run.
+
+Handlers are registered with the `handler` decorator (see `tasks.py`).
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from datetime import timedelta
+
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from models import Job # gives us access to the job table
+
+BATCH_SIZE = 100 # Jobs of one kind handed to a handler at once
+LEASE = 300 # Seconds a worker may hold claimed jobs before they are offered again
+MAX_ATTEMPTS = 5 # Runs before a job is marked failed
+RETRY_DELAY = 10 # Seconds before the first retry; doubles on each further attempt
+POLL_INTERVAL = 1.0 # Seconds an idle worker sleeps between polls
+
+HANDLERS = {} # kind -> handler function taking a list of payloads
+
+
+def handler(kind):
+    """
+    Registers a function as the handler for jobs of `kind`.
+
+    The function receives a list of payload dictionaries (one per job, oldest
+    first) and should apply them together. Raising fails the whole batch and
+    rolls back its database writes (side effects outside the database, such as
+    files, must be safe to repeat).
+    """
+
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def worker_name():
+    """Identifies this worker thread in `Job.locked_by` tokens."""
+
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(), threading.current_thread().name)
+
+
+def claim(batch_size=BATCH_SIZE, lease=LEASE):
+    """
+    Claims up to `batch_size` ready jobs of a single kind.
+
+    The claiming `UPDATE` repeats the "ready" conditions, so when two workers
+    race for the same rows only one of them gets each row.
+
+    Returns a list of claimed `Job` objects (empty if nothing is ready).
+    """
+
+    now = timezone.now()
+    ready = Job.objects.filter(status=Job.PENDING, run_after__lte=now).filter(Q(locked_until__isnull=True) | Q(locked_until__lt=now))
+    oldest = ready.order_by("id").first()
+    if oldest is None:
+        return []
+    ids = list(ready.filter(kind=oldest.kind).order_by("id").values_list("id", flat=True)[:batch_size])
+    token = "{}:{}".format(worker_name(), uuid.uuid4().hex[:8])
+    ready.filter(id__in=ids).update(locked_by=token, locked_until=now + timedelta(seconds=lease))
+    return list(Job.objects.filter(locked_by=token, status=Job.PENDING).order_by("id"))
+
+
+def collapse_duplicates(jobs):
+    """Drops claimed jobs whose `dedupe_key` already appears earlier in the batch; returns the rest."""
+
+    seen = set()
+    keep, duplicates = [], []
+    for job in jobs:
+        if job.dedupe_key is not None and job.dedupe_key in seen:
+            duplicates.append(job.id)
+        else:
+            seen.add(job.dedupe_key)
+            keep.append(job)
+    if duplicates:
+        Job.objects.filter(id__in=duplicates).delete()
+    return keep
+
+
+def run_batch(jobs):
+    """Runs one claimed batch through its handler, then deletes or reschedules the jobs."""
+
+    jobs = collapse_duplicates(jobs)
+    kind = jobs[0].kind
+    ids = [job.id for job in jobs]
+    try:
+        if kind not in HANDLERS:
+            raise LookupError("No handler registered for job kind '{}'.".format(kind))
+        # Apply and delete in one transaction: a batch that fails (or a worker that dies) part-way commits nothing:
+        with transaction.atomic():
+            HANDLERS[kind]([json.loads(job.payload) for job in jobs])
+            Job.objects.filter(id__in=ids).delete()
+    except Exception:
+        error = traceback.format_exc()
+        print "Job batch failed ({} x {}):".format(len(jobs), kind)
+        print error
+        now = timezone.now()
+        for job in jobs:
+            job.attempts += 1
+            job.last_error = error
+            job.locked_by = None
+            job.locked_until = None
+            if job.attempts >= MAX_ATTEMPTS:
+                job.status = Job.FAILED
+            else:
+                job.run_after = now + timedelta(seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+            job.save()
+        return False
+    return True
+
+
+def work(stop=None, once=False, batch_size=BATCH_SIZE, poll_interval=POLL_INTERVAL):
+    """
+    Worker loop: claims and runs batches until `stop` is set.
+
+    Parameters:
+    - `stop` - `threading.Event` (or anything with `is_set()`) ending the loop.
+    - `once` - Return as soon as the queue is empty instead of polling.
+    - `batch_size` - Jobs claimed per batch.
+    - `poll_interval` - Seconds to sleep when the queue is empty.
+
+    Returns the number of batches run.
+    """
+
+    batches = 0
+    while stop is None or not stop.is_set():
+        close_old_connections()
+        jobs = claim(batch_size=batch_size)
+        if jobs:
+            run_batch(jobs)
+            batches += 1
+            continue
+        if once:
+            break
+        time.sleep(poll_interval)
+    close_old_connections()
+    return batches
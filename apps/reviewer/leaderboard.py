@@ -0,0 +1,215 @@
+"""
+Trending and top-rated book leaderboards for the dashboard.
+
+Two lists are kept without ever aggregating over `Review` at request time:
+
+- Trending: every `BookScore` row holds a time-decayed score that is updated
+incrementally on each review write (by the `review_changed` background job; its
+review count and rating sum are kept by `ReviewManager` as the review is written). Scores are stored in log space relative to
+a fixed epoch, `log(sum(exp(DECAY_RATE * (t - EPOCH))))`, so a newer review
+always outweighs an older one and ordering by the stored column gives the same
+ranking as decaying every score to "now" -- no periodic rescoring needed.
+- Top rated: a Bayesian average of each book's ratings, shrunk towards the site
+mean, materialized into `TopRatedBook` by `refresh_top_rated()` (see the
+`refresh_leaderboards` management command).
+
+Both lists are kept in a small per-process top-N heap with a TTL in front of
+the database.
+"""
+
+from __future__ import division
+
+import heapq
+import math
+import threading
+import time
+from datetime import datetime
+
+from django.db import transaction
+from django.db.models import F, Sum, ExpressionWrapper, FloatField
+from django.utils import timezone
+
+from models import Book, BookScore, TopRatedBook # gives us access to models
+from archive import iter_all_reviews # reads both review partitions
+
+HALF_LIFE = 7 * 24 * 60 * 60 # Seconds for a review's weight in "trending" to halve
+DECAY_RATE = math.log(2) / HALF_LIFE
+EPOCH = datetime(2017, 1, 1, tzinfo=timezone.utc) # Fixed reference point for stored scores
+PRIOR_WEIGHT = 5 # Number of "site average" votes every book starts with in the Bayesian average
+BOARD_SIZE = 10 # Books shown per leaderboard
+CACHE_TTL = 60 # Seconds a process trusts its in-memory leaderboard
+
+
+def decay_exponent(created_at):
+    """Returns the log-space weight of a review written at `created_at`."""
+
+    return DECAY_RATE * (created_at - EPOCH).total_seconds()
+
+
+def add_log(score, exponent):
+    """Adds `exp(exponent)` to a log-space `score` (None means empty)."""
+
+    if score is None:
+        return exponent
+    high, low = max(score, exponent), min(score, exponent)
+    return high + math.log1p(math.exp(low - high))
+
+
+def subtract_log(score, exponent):
+    """Removes `exp(exponent)` from a log-space `score`; returns None once nothing is left."""
+
+    if score is None or exponent >= score:
+        return None
+    remainder = -math.expm1(exponent - score)
+    if remainder < 1e-12: # Floating point leftovers of the last review
+        return None
+    return score + math.log(remainder)
+
+
+def current_heat(score, now=None):
+    """Converts a stored log-space score into the decayed number of reviews as of `now`."""
+
+    if score is None:
+        return 0.0
+    now = now or timezone.now()
+    return math.exp(score - decay_exponent(now))
+
+
+class TopN(object):
+    """
+    Per-process top-N heap with a TTL.
+
+    Holds `{book_id: (score, book)}` for one leaderboard and reloads it from the
+    database once the TTL expires, so background writes show up within `ttl`.
+    """
+
+    def __init__(self, loader, size=BOARD_SIZE, ttl=CACHE_TTL):
+        self.loader = loader # Returns a list of `(score, book)` from the database
+        self.size = size
+        self.ttl = ttl
+        self.entries = {}
+        self.expires_at = 0
+        self.lock = threading.Lock()
+
+    def top(self):
+        """Returns the best `(score, book)` pairs, best first."""
+
+        with self.lock:
+            if time.time() >= self.expires_at:
+                self.entries = dict((book.id, (score, book)) for score, book in self.loader(self.size))
+                self.expires_at = time.time() + self.ttl
+            return heapq.nlargest(self.size, self.entries.values(), key=lambda entry: entry[0])
+
+    def clear(self):
+        with self.lock:
+            self.expires_at = 0
+
+
+def _load_trending(size):
+    rows = BookScore.objects.filter(trending_score__isnull=False).select_related("book").order_by("-trending_score")[:size]
+    return [(row.trending_score, row.book) for row in rows]
+
+
+def _load_top_rated(size):
+    rows = TopRatedBook.objects.select_related("book").order_by("rank")[:size]
+    return [(row.score, row.book) for row in rows]
+
+
+_trending = TopN(_load_trending)
+_top_rated = TopN(_load_top_rated)
+
+
+def trending():
+    """Returns the trending books as a list of `Book` objects with a `heat` attribute."""
+
+    now = timezone.now()
+    books = []
+    for score, book in _trending.top():
+        book.heat = current_heat(score, now)
+        books.append(book)
+    return books
+
+
+def top_rated():
+    """Returns the top rated books as a list of `Book` objects with a `bayesian_rating` attribute."""
+
+    books = []
+    for score, book in _top_rated.top():
+        book.bayesian_rating = score
+        books.append(book)
+    return books
+
+
+def apply_reviews(changes):
+    """
+    Applies a batch of review writes and deletes to the per-book trending scores.
+
+    Called from the `review_changed` background job (see `tasks.py`), so the
+    request that wrote the review never waits on it.
+
+    Parameters:
+    - `changes` - List of `(book_id, rating, created_at, added)` tuples, oldest
+    first. `added` is False for deleted reviews.
+    """
+
+    by_book = {}
+    for book_id, rating, created_at, added in changes:
+        by_book.setdefault(book_id, []).append((rating, created_at, added))
+
+    for book_id, book_changes in by_book.items():
+        if not Book.objects.filter(id=book_id).exists():
+            continue # Book deleted since; its score went with it
+        with transaction.atomic():
+            BookScore.objects.get_or_create(book_id=book_id)
+            trending_score = BookScore.objects.select_for_update().get(book_id=book_id).trending_score
+            for rating, created_at, added in book_changes:
+                if added:
+                    trending_score = add_log(trending_score, decay_exponent(created_at))
+                else:
+                    trending_score = subtract_log(trending_score, decay_exponent(created_at))
+            BookScore.objects.filter(book_id=book_id).update(trending_score=trending_score)
+
+
+def refresh_top_rated(size=BOARD_SIZE, prior_weight=PRIOR_WEIGHT):
+    """
+    Materializes the Bayesian-average ranking into `TopRatedBook`.
+
+    Each book's rating is `(C * m + rating_sum) / (C + review_count)`, where `m`
+    is the site-wide mean rating and `C` is `prior_weight`, so a book with one
+    5-star review does not outrank a book with hundreds of 4.8s. Reads only the
+    `BookScore` counters, never `Review`.
+    """
+
+    totals = BookScore.objects.aggregate(ratings=Sum("rating_sum"), reviews=Sum("review_count"))
+    if not totals["reviews"]:
+        mean = 0.0
+    else:
+        mean = totals["ratings"] / totals["reviews"]
+    bayesian = ExpressionWrapper((F("rating_sum") + prior_weight * mean) * 1.0 / (F("review_count") + prior_weight), output_field=FloatField())
+    best = BookScore.objects.filter(review_count__gt=0).annotate(bayesian=bayesian).order_by("-bayesian", "-review_count")[:size]
+    rows = [TopRatedBook(rank=rank, book_id=score.book_id, score=score.bayesian, review_count=score.review_count) for rank, score in enumerate(best)]
+    with transaction.atomic():
+        TopRatedBook.objects.all().delete()
+        TopRatedBook.objects.bulk_create(rows)
+    _top_rated.clear()
+    return rows
+
+
+def rebuild_scores():
+    """
+    Recomputes every `BookScore` from scratch by scanning all reviews, archived ones included.
+
+    Only for backfilling after the first migration or repairing drift -- this is
+    the one place that aggregates over reviews, and it runs offline.
+    """
+
+    scores = {}
+    for book_id, rating, created_at in iter_all_reviews("book_id", "rating", "created_at"):
+        count, total, trending_score = scores.get(book_id, (0, 0, None))
+        scores[book_id] = (count + 1, total + rating, add_log(trending_score, decay_exponent(created_at)))
+    rows = [BookScore(book_id=book_id, review_count=book_count, rating_sum=book_total, trending_score=book_score) for book_id, (book_count, book_total, book_score) in scores.items()]
+    with transaction.atomic():
+        BookScore.objects.all().delete()
+        BookScore.objects.bulk_create(rows, batch_size=500)
+    _trending.clear()
+    return len(rows)
@@ -0,0 +1,26 @@
+"""Moves old reviews to the cold `ArchivedReview` table."""
+
+from django.core.management.base import BaseCommand
+
+from apps.reviewer import archive
+
+
+class Command(BaseCommand):
+    """
+    Archives reviews older than N months (see `archive.py`).
+
+    Usage:
+    - `python manage.py archive_reviews` - Run periodically (e.g. nightly from cron).
+    - `python manage.py archive_reviews --months 6 --batch-size 1000`
+    """
+
+    help = "Moves reviews older than --months from the hot review table to the archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--months", type=int, default=archive.DEFAULT_MONTHS, help="Archive reviews older than this many (30-day) months.")
+        parser.add_argument("--batch-size", type=int, default=archive.BATCH_SIZE, help="Reviews moved per transaction.")
+
+    def handle(self, *args, **options):
+        before = archive.cutoff(options["months"])
+        moved = archive.archive_reviews(before, batch_size=options["batch_size"])
+        self.stdout.write("Archived {} reviews created before {}.".format(moved, before.date()))
@@ -0,0 +1,27 @@
+"""Builds or refreshes the "readers who liked this also liked" table."""
+
+from django.core.management.base import BaseCommand
+
+from apps.reviewer import recommender
+
+
+class Command(BaseCommand):
+    """
+    Runs the offline recommendation job in `recommender.py`.
+
+    Usage:
+    - `python manage.py build_recommendations` - Refresh books touched since the last run.
+    - `python manage.py build_recommendations --full` - Recompute every book.
+    """
+
+    help = "Precomputes top-K similar books for every book page."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--full", action="store_true", help="Recompute every book instead of only touched ones.")
+        parser.add_argument("--top-k", type=int, default=recommender.TOP_K, help="Neighbors stored per book.")
+        parser.add_argument("--metric", choices=recommender.METRICS, default="cosine", help="Similarity measure.")
+
+    def handle(self, *args, **options):
+        run = recommender.refresh(full=options["full"], top_k=options["top_k"], metric=options["metric"])
+        elapsed = (run.finished_at - run.started_at).total_seconds()
+        self.stdout.write("{} run refreshed {} books in {:.2f}s.".format("Full" if run.full else "Incremental", run.books_refreshed, elapsed))
@@ -0,0 +1,28 @@
+"""Rebuilds the pre-rendered book pages served to logged-out visitors."""
+
+from django.core.management.base import BaseCommand
+
+from apps.reviewer import snapshots
+
+
+class Command(BaseCommand):
+    """
+    Re-renders every book's snapshot (see `snapshots.py`).
+
+    Usage:
+    - `python manage.py build_snapshots` - Run on every deploy (templates or static
+    file names may have changed) and after `build_recommendations`.
+    - `python manage.py build_snapshots --book 12` - Just one book.
+    """
+
+    help = "Regenerates the gzip-compressed snapshots of public book pages."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--book", type=int, action="append", help="Only this book id (repeatable).")
+
+    def handle(self, *args, **options):
+        if options["book"]:
+            written = sum(snapshots.write(book_id) for book_id in options["book"])
+        else:
+            written = snapshots.build_all()
+        self.stdout.write("Wrote {} book snapshots.".format(written))
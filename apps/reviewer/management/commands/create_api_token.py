@@ -0,0 +1,27 @@
+"""Issues an API token for a partner integration."""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.reviewer.models import User, ApiToken
+
+
+class Command(BaseCommand):
+    """
+    Creates an `ApiToken` for the batch review endpoint (`/api/reviews/batch`).
+
+    Usage:
+    - `python manage.py create_api_token --user-id 12 --name "Acme Books"`
+    """
+
+    help = "Creates an API token that posts reviews as the given user."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user-id", type=int, required=True, help="User the partner's reviews are posted as.")
+        parser.add_argument("--name", required=True, help="Partner name, for humans.")
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(id=options["user_id"]).first()
+        if user is None:
+            raise CommandError("No user with id {}.".format(options["user_id"]))
+        token = ApiToken.objects.create(key=ApiToken.generate_key(), user=user, name=options["name"])
+        self.stdout.write("Token for {} (posting as {} {}): {}".format(token.name, user.first_name, user.last_name, token.key))
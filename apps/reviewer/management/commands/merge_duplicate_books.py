@@ -0,0 +1,49 @@
+"""Merges books whose titles normalize to the same key for the same author."""
+
+from django.core.management.base import BaseCommand
+
+from apps.reviewer import singleflight, snapshots
+from apps.reviewer.models import Book, Review, BookScore, ArchivedReview, AuthorStats
+from apps.reviewer.titles import normalize_title, merge_duplicate_books
+
+
+class Command(BaseCommand):
+    """
+    Folds duplicate books ("The Shining" / "Shining, The") into the oldest copy.
+
+    Usage:
+    - `python manage.py merge_duplicate_books --dry-run` - List what would be merged.
+    - `python manage.py merge_duplicate_books` - Move reviews onto the kept books and delete the rest.
+
+    Titles are compared by freshly computed keys, so books saved before a change
+    to `titles.normalize_title()` are matched with the current rules; stored keys
+    are refreshed afterwards.
+    """
+
+    help = "Merges duplicate books into one per author and normalized title."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report duplicates.")
+
+    def handle(self, *args, **options):
+        merged = merge_duplicate_books(Book, Review, BookScore, ArchivedReview, dry_run=options["dry_run"])
+        for kept_id, duplicate_ids in merged:
+            self.stdout.write("Book {} <- {}".format(kept_id, ", ".join(str(book_id) for book_id in duplicate_ids)))
+        if not options["dry_run"]:
+            self.refresh_title_keys()
+            # Kept books gained reviews; merged books' snapshots are removed:
+            for kept_id, duplicate_ids in merged:
+                for book_id in [kept_id] + duplicate_ids:
+                    snapshots.write(book_id)
+                    singleflight.bump("book:{}".format(book_id))
+            # Merged books no longer count towards their authors:
+            if merged:
+                AuthorStats.objects.rebuild(author_ids=list(Book.objects.filter(id__in=[kept_id for kept_id, duplicate_ids in merged]).values_list("author_id", flat=True)))
+        self.stdout.write("{} {} books into {}.".format("Would merge" if options["dry_run"] else "Merged", sum(len(ids) for kept, ids in merged), len(merged)))
+
+    def refresh_title_keys(self):
+        """Re-saves books whose stored key is out of date (`Book.save()` recomputes it and the trigrams)."""
+
+        for book in Book.objects.all().iterator():
+            if book.title_key != normalize_title(book.title):
+                book.save()
@@ -0,0 +1,47 @@
+"""Summarizes the request profiles written by `ProfilingMiddleware`."""
+
+import pstats
+from StringIO import StringIO
+
+from django.core.management.base import BaseCommand
+
+from apps.reviewer import profiling
+
+
+class Command(BaseCommand):
+    """
+    Aggregates every dump in `settings.PROFILING_DIR` into a top-functions report.
+
+    Usage:
+    - `python manage.py profile_report` - All views.
+    - `python manage.py profile_report --view book --limit 20 --sort tottime`
+    """
+
+    help = "Prints the most expensive functions across collected request profiles."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--view", help="Only dumps of this view function (e.g. book).")
+        parser.add_argument("--limit", type=int, default=30, help="Functions listed per section.")
+        parser.add_argument("--sort", default="cumulative", help="pstats sort key for cProfile dumps (cumulative, tottime, calls...).")
+
+    def handle(self, *args, **options):
+        prof_paths, collapsed_paths = profiling.dumps(options["view"])
+
+        if prof_paths:
+            self.stdout.write("=== cProfile: {} dumps, top {} by {} ===".format(len(prof_paths), options["limit"], options["sort"]))
+            report = StringIO() # pstats writes piecemeal; collect it before handing it to `self.stdout`
+            stats = pstats.Stats(*prof_paths, stream=report)
+            stats.strip_dirs().sort_stats(options["sort"]).print_stats(options["limit"])
+            self.stdout.write(report.getvalue())
+
+        if collapsed_paths:
+            own, total = profiling.read_collapsed(collapsed_paths)
+            samples = sum(own.values()) or 1
+            self.stdout.write("=== Stack samples: {} dumps, {} samples ===".format(len(collapsed_paths), sum(own.values())))
+            for title, counter in (("Running (self)", own), ("On stack (inclusive)", total)):
+                self.stdout.write("--- {} ---".format(title))
+                for frame, count in counter.most_common(options["limit"]):
+                    self.stdout.write("{:6.1f}%  {:6d}  {}".format(100.0 * count / samples, count, frame))
+
+        if not prof_paths and not collapsed_paths:
+            self.stdout.write("No profiles found.")
@@ -0,0 +1,29 @@
+"""Refreshes the materialized dashboard leaderboards."""
+
+from django.core.management.base import BaseCommand
+
+from apps.reviewer import leaderboard
+
+
+class Command(BaseCommand):
+    """
+    Rewrites the "top rated" table from the per-book counters in `leaderboard.py`.
+
+    Usage:
+    - `python manage.py refresh_leaderboards` - Run periodically (e.g. from cron).
+    - `python manage.py refresh_leaderboards --rebuild` - Recompute the per-book
+    counters from every review first. Run once after migrating, or to repair drift.
+    """
+
+    help = "Materializes the Bayesian-average top rated leaderboard."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rebuild", action="store_true", help="Recompute per-book counters and trending scores from all reviews first.")
+        parser.add_argument("--size", type=int, default=leaderboard.BOARD_SIZE, help="Books kept on the leaderboard.")
+        parser.add_argument("--prior-weight", type=float, default=leaderboard.PRIOR_WEIGHT, help="Site-average votes added to every book.")
+
+    def handle(self, *args, **options):
+        if options["rebuild"]:
+            self.stdout.write("Rebuilt scores for {} books.".format(leaderboard.rebuild_scores()))
+        rows = leaderboard.refresh_top_rated(size=options["size"], prior_weight=options["prior_weight"])
+        self.stdout.write("Top rated leaderboard refreshed with {} books.".format(len(rows)))
@@ -0,0 +1,54 @@
+"""Reports rating distributions per author, month and reviewer cohort."""
+
+import csv
+import json
+from StringIO import StringIO
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.reviewer import reports
+
+
+class Command(BaseCommand):
+    """
+    Runs the streaming report in `reports.py` over every review (archived ones too).
+
+    Usage:
+    - `python manage.py review_report` - Every grouping, CSV on stdout.
+    - `python manage.py review_report --by author --by month --format json --output report.json`
+    """
+
+    help = "Reports rating histograms, means and percentiles per author, month and reviewer cohort."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--by", action="append", choices=reports.GROUPINGS, help="Grouping to report (repeatable; default all).")
+        parser.add_argument("--format", choices=("csv", "json"), default="csv", help="Output format.")
+        parser.add_argument("--output", help="File to write instead of stdout.")
+        parser.add_argument("--chunk-size", type=int, default=reports.CHUNK_SIZE, help="Rows pulled from the database per chunk.")
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive.")
+        groupings = [grouping for grouping in reports.GROUPINGS if grouping in (options["by"] or reports.GROUPINGS)]
+        histograms, invalid = reports.collect(groupings, chunk_size=options["chunk_size"])
+        report = [(grouping, reports.summarize(grouping, histograms[grouping])) for grouping in groupings]
+
+        output = StringIO() # one group per row, so this is as big as the report, not the review table
+        if options["format"] == "json":
+            json.dump(dict(report), output, indent=2, sort_keys=True)
+            output.write("\n")
+        else:
+            writer = csv.DictWriter(output, fieldnames=reports.columns())
+            writer.writeheader()
+            for grouping, rows in report:
+                for row in rows:
+                    writer.writerow(dict((key, value.encode("utf-8") if isinstance(value, unicode) else value) for key, value in row.items()))
+
+        if options["output"]:
+            with open(options["output"], "wb") as handle:
+                handle.write(output.getvalue())
+            self.stdout.write("Wrote {} rows to {}.".format(sum(len(rows) for grouping, rows in report), options["output"]))
+        else:
+            self.stdout.write(output.getvalue(), ending="")
+        if invalid:
+            self.stderr.write("Left out {} reviews with a rating outside 1-{}.".format(invalid, reports.MAX_RATING))
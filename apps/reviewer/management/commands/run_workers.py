@@ -0,0 +1,70 @@
+"""Runs the background job workers."""
+
+import multiprocessing
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from apps.reviewer import jobs
+from apps.reviewer import tasks # registers the job handlers
+
+
+def run_threads(threads, once, batch_size, poll_interval):
+    """Runs `threads` worker loops in this process until interrupted (or drained with `once`)."""
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    workers = [threading.Thread(target=jobs.work, name="worker-{}".format(i), kwargs={"stop": stop, "once": once, "batch_size": batch_size, "poll_interval": poll_interval}) for i in range(threads)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    try:
+        # Join with a timeout so Ctrl-C still reaches the main thread:
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(0.5)
+    except KeyboardInterrupt:
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+
+class Command(BaseCommand):
+    """
+    Claims and runs queued `Job` rows (see `jobs.py` and `tasks.py`).
+
+    Usage:
+    - `python manage.py run_workers` - 2 worker threads in one process.
+    - `python manage.py run_workers --processes 4 --threads 2` - Process pool, 2 threads each.
+    - `python manage.py run_workers --once` - Drain the queue and exit.
+    """
+
+    help = "Runs background job workers for post-write side effects."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=1, help="Worker processes to fork.")
+        parser.add_argument("--threads", type=int, default=2, help="Worker threads per process.")
+        parser.add_argument("--batch-size", type=int, default=jobs.BATCH_SIZE, help="Jobs of one kind run per batch.")
+        parser.add_argument("--poll-interval", type=float, default=jobs.POLL_INTERVAL, help="Seconds between polls when idle.")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty.")
+
+    def handle(self, *args, **options):
+        worker_args = (options["threads"], options["once"], options["batch_size"], options["poll_interval"])
+        self.stdout.write("Starting {} x {} job workers...".format(options["processes"], options["threads"]))
+        if options["processes"] <= 1:
+            run_threads(*worker_args)
+            return
+        # Never share database connections across a fork:
+        connections.close_all()
+        processes = [multiprocessing.Process(target=run_threads, args=worker_args) for i in range(options["processes"])]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+                process.join()
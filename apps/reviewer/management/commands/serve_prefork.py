@@ -0,0 +1,236 @@
+"""Runs the site with a pre-forking WSGI server that loads the app once, in the master."""
+
+import errno
+import gc
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import time
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from apps.reviewer import metrics
+
+PROCESS_LOCAL_CACHES = ("django.core.cache.backends.locmem.LocMemCache",)
+RESPAWN_DELAY = 1.0 # Seconds to wait before replacing a worker that crashed, so a broken deploy doesn't spin
+
+
+class QuietHandler(WSGIRequestHandler):
+    """Leaves access logging to the front server."""
+
+    def log_message(self, format, *args):
+        pass
+
+
+def load_application(preload):
+    """Imports the WSGI application and, with `preload`, everything the first request would load lazily."""
+
+    from django_book_reviewer.wsgi import application # builds the middleware chain
+    if preload:
+        import mimetypes
+        from django.template.loader import get_template
+        from django.urls import get_resolver
+        from apps.reviewer import views
+
+        get_resolver().url_patterns # imports every view
+        for config in apps.get_app_configs():
+            directory = os.path.join(config.path, "templates")
+            if not config.path.startswith(settings.BASE_DIR) or not os.path.isdir(directory):
+                continue # compile our own templates only
+            for root, dirs, files in os.walk(directory):
+                for name in files:
+                    if name.endswith(".html"):
+                        get_template(os.path.relpath(os.path.join(root, name), directory))
+        views._hashed_static_names() # static files manifest
+        mimetypes.init()
+    return application
+
+
+def memory_usage():
+    """
+    Returns this process's resident and shared memory in bytes (Linux only, else None).
+
+    Shared pages are those still mapped by other processes too -- for a worker,
+    mostly the copy-on-write pages inherited from the master.
+    """
+
+    fields = {}
+    for path in ("/proc/self/smaps_rollup", "/proc/self/smaps"):
+        try:
+            with open(path) as handle:
+                for line in handle:
+                    parts = line.split()
+                    if len(parts) == 3 and parts[2] == "kB":
+                        fields[parts[0]] = fields.get(parts[0], 0) + int(parts[1]) * 1024
+            break
+        except IOError:
+            continue
+    if "Rss:" not in fields:
+        return None
+    return fields["Rss:"], fields.get("Shared_Clean:", 0) + fields.get("Shared_Dirty:", 0)
+
+
+def describe_memory():
+    usage = memory_usage()
+    if usage is None:
+        return "RSS unknown"
+    return "RSS {:.1f} MB ({:.1f} MB shared)".format(usage[0] / 1048576.0, usage[1] / 1048576.0)
+
+
+def serve(listener, application, max_requests, stdout):
+    """
+    Worker loop: accepts and answers requests one at a time until told to stop
+    or `max_requests` are done (0 = never). Idle workers all block in
+    `accept()` on the shared socket; the kernel hands each connection to one.
+    """
+
+    started = time.time()
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum)) # finish the current request first
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl-C reaches the master, which stops us
+    random.seed() # don't share the master's random sequence with every sibling
+
+    if application is None:
+        application = load_application(preload=False)
+    host, port = listener.getsockname()[:2]
+    server = WSGIServer((host, port), QuietHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = listener
+    server.server_name, server.server_port = socket.getfqdn(host), port
+    server.setup_environ()
+    server.set_app(application)
+    ready = time.time() - started
+
+    handled = 0
+    while not stopping and (not max_requests or handled < max_requests):
+        try:
+            request, address = listener.accept()
+        except socket.error as error:
+            if error.args[0] in (errno.EINTR, errno.EAGAIN, errno.ECONNABORTED):
+                continue
+            raise
+        accepted = time.time()
+        try:
+            server.process_request(request, address)
+        except Exception:
+            server.handle_error(request, address)
+            server.shutdown_request(request)
+        handled += 1
+        if handled == 1:
+            stdout.write("Worker {}: ready {:.0f} ms after fork, first request took {:.0f} ms, {}".format(os.getpid(), ready * 1000, (time.time() - accepted) * 1000, describe_memory()))
+    stdout.write("Worker {}: exiting after {} requests, {}".format(os.getpid(), handled, describe_memory()))
+
+
+class Command(BaseCommand):
+    """
+    Production entry point: a pre-forking WSGI server for behind nginx.
+
+    The master imports the app, builds the URL resolver, compiles every
+    template and loads the static files manifest, then forks the workers, so
+    they share that memory copy-on-write instead of each loading their own.
+    Before forking it runs a full garbage collection and, where the
+    interpreter has it (Python 3.7+), `gc.freeze()`, so the workers' own
+    collections never walk -- and copy -- the inherited objects.
+
+    Workers handle one request at a time and are replaced after
+    `--max-requests` (plus up to `--max-requests-jitter`, so they don't all
+    restart at once), or when they crash. Admission control's per-process
+    limits don't apply to one-request workers; size `--workers` instead (the
+    `X-Request-Start` deadline still sheds requests that queued too long).
+    Each reports how long it took to get ready and to answer its first
+    request, and its memory; `--no-preload` makes every worker load the app
+    itself, as a generic server does, for comparison.
+
+    Refuses to start on a per-process cache backend (`LocMemCache`): the
+    workers would each keep their own cached rows and pages, and never see
+    each other's invalidations (see `settings.CACHES`).
+
+    Usage:
+    - `python manage.py serve_prefork --bind 127.0.0.1:8000 --workers 8`
+    - `python manage.py serve_prefork --no-preload` - Load per worker (baseline).
+    """
+
+    help = "Runs a pre-forking WSGI server with the app preloaded in the master."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bind", default="127.0.0.1:8000", help="Address to listen on, host:port.")
+        parser.add_argument("--workers", type=int, default=2 * multiprocessing.cpu_count(), help="Worker processes to fork.")
+        parser.add_argument("--max-requests", type=int, default=1000, help="Requests a worker serves before it is replaced (0 = never).")
+        parser.add_argument("--max-requests-jitter", type=int, default=100, help="Up to this many extra requests per worker, at random.")
+        parser.add_argument("--backlog", type=int, default=128, help="Connections the kernel queues while every worker is busy.")
+        parser.add_argument("--no-preload", action="store_false", dest="preload", help="Load the app in each worker instead of the master.")
+
+    def handle(self, *args, **options):
+        if settings.CACHES["default"]["BACKEND"] in PROCESS_LOCAL_CACHES:
+            raise CommandError("CACHES['default'] is {}, which every worker would keep to itself; configure a shared cache (see settings.py).".format(settings.CACHES["default"]["BACKEND"]))
+        host, separator, port = options["bind"].rpartition(":")
+        if not separator or not port.isdigit():
+            raise CommandError("--bind must look like host:port.")
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host or "0.0.0.0", int(port)))
+        listener.listen(options["backlog"])
+
+        started = time.time()
+        application = load_application(preload=True) if options["preload"] else None
+        self.stdout.write("Master {}: {} in {:.0f} ms, {}".format(os.getpid(), "app preloaded" if options["preload"] else "not preloading", (time.time() - started) * 1000, describe_memory()))
+        # Never share database connections across a fork:
+        connections.close_all()
+        gc.collect()
+        if options["preload"] and hasattr(gc, "freeze"):
+            gc.freeze()
+
+        workers = {} # pid -> fork time
+        def spawn():
+            limit = options["max_requests"] and options["max_requests"] + random.randint(0, options["max_requests_jitter"])
+            self.stdout.flush() # or the child writes our buffered output again
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    serve(listener, application, limit, self.stdout)
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+                    code = 1
+                finally:
+                    self.stdout.flush()
+                    os._exit(code)
+            workers[pid] = time.time()
+
+        stopping = []
+        def stop(signum, frame):
+            stopping.append(signum)
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass # Already gone
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        for i in range(options["workers"]):
+            spawn()
+        self.stdout.write("Listening on {}:{} with {} workers.".format(host or "0.0.0.0", port, options["workers"]))
+        while workers:
+            try:
+                pid, status = os.wait()
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                break
+            workers.pop(pid, None)
+            metrics.retire(pid)
+            if stopping:
+                continue
+            if status != 0:
+                self.stderr.write("Worker {} died (status {}); replacing it.".format(pid, status))
+                time.sleep(RESPAWN_DELAY)
+            spawn()
+        listener.close()
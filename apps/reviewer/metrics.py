@@ -0,0 +1,258 @@
+"""
+Per-view request metrics and other counters kept in memory-mapped files,
+exported in Prometheus text format at `/metrics` (see
+`middleware.MetricsMiddleware` and `views.metrics_export`).
+
+Every worker thread owns one fixed-layout file of float64 slots under
+`settings.METRICS_DIR`, so recording a request is a handful of in-place adds
+with no locks and no shared writes. The exporter sums all files, which
+combines every worker process (and keeps the counts of workers that exited:
+a process folds its files into a shared "retired" file when it exits, and
+`collect()` does it for processes that died without doing so).
+
+Layout: for each view in `VIEWS` and each histogram in `HISTOGRAMS`, one slot
+per bucket (plus +Inf), then the sum and the count of observations; then one
+slot per label combination of each counter in `COUNTERS`.
+"""
+
+import atexit
+import errno
+import fcntl
+import glob
+import os
+import mmap
+import struct
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+
+LAYOUT_VERSION = 5 # Bump whenever VIEWS, HISTOGRAMS, COUNTERS or the bucket bounds change
+
+VIEWS = (
+    "index", "login", "logout", "get_dashboard_data", "add_review",
+    "book", "user", "destroy_review", "author", "follow", "unfollow",
+    "api_reviews_batch", "static_asset", "metrics_export", "other",
+)
+
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# (name, help text, bucket upper bounds)
+HISTOGRAMS = (
+    ("reviewer_request_duration_seconds", "Time from request to response, per view.", SECONDS),
+    ("reviewer_request_sql_seconds", "Time spent in SQL queries, per view.", SECONDS),
+    ("reviewer_request_render_seconds", "Time spent rendering templates (including queries run lazily from templates), per view.", SECONDS),
+    ("reviewer_response_size_bytes", "Response body size, per view.", BYTES),
+)
+
+# (name, help text, label names, every label value combination)
+COUNTERS = (
+    ("reviewer_pkcache_lookups_total", "Primary-key cache lookups, by model and the tier that answered (see pkcache.py).",
+        ("model", "tier"), tuple((model, tier) for model in ("book", "author", "user") for tier in ("local", "shared", "database"))),
+    ("reviewer_admission_shed_total", "Requests rejected with a 503 by admission control, by route class and reason (see admission.py).",
+        ("route", "reason"), tuple((route, reason) for route in ("auth", "write", "read") for reason in ("queue_full", "deadline"))),
+    ("reviewer_singleflight_total", "Single-flight cache reads, by cache and outcome (see singleflight.py).",
+        ("cache", "outcome"), tuple((name, outcome) for name in ("book_page", "dashboard") for outcome in ("fresh", "stale", "early", "waited", "computed"))),
+)
+
+SLOT = 8 # bytes per float64
+_offsets = {}
+_size = 0
+for _view in VIEWS:
+    for _name, _help, _bounds in HISTOGRAMS:
+        _offsets[(_view, _name)] = _size
+        _size += len(_bounds) + 3 # buckets, +Inf, sum, count
+for _name, _help, _labels, _values in COUNTERS:
+    for _value in _values:
+        _offsets[(_name, _value)] = _size
+        _size += 1
+FILE_SLOTS = _size
+_buckets = dict((name, buckets) for name, help_text, buckets in HISTOGRAMS)
+
+_local = threading.local()
+
+
+def metrics_dir():
+    return settings.METRICS_DIR
+
+
+def _thread_map():
+    """Returns this thread's mmap, creating its file on first use."""
+
+    shared = getattr(_local, "map", None)
+    if shared is not None and _local.pid == os.getpid():
+        return shared
+    directory = metrics_dir()
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass # Another worker created it first
+    path = os.path.join(directory, "metrics-v{}-{}-{}.bin".format(LAYOUT_VERSION, os.getpid(), threading.current_thread().ident))
+    with open(path, "a+b") as handle:
+        handle.truncate(FILE_SLOTS * SLOT)
+        _local.map = mmap.mmap(handle.fileno(), FILE_SLOTS * SLOT)
+    _local.pid = os.getpid()
+    _retire_at_exit()
+    return _local.map
+
+
+_exit_lock = threading.Lock()
+_exit_pids = set()
+
+
+def _retire_at_exit():
+    """Registers (once per process) folding this process's files away when it exits."""
+
+    pid = os.getpid()
+    with _exit_lock:
+        if pid in _exit_pids:
+            return
+        _exit_pids.add(pid)
+    # Forked children inherit the handler, and must not fold their parent's files:
+    atexit.register(lambda: os.getpid() == pid and retire(pid))
+
+
+def observe(view, histogram, value):
+    """
+    Records one observation.
+
+    Parameters:
+    - `view` - View function name; anything not in `VIEWS` counts as "other".
+    - `histogram` - Name from `HISTOGRAMS`.
+    - `value` - Seconds or bytes.
+    """
+
+    if view not in VIEWS:
+        view = "other"
+    buckets = _buckets[histogram]
+    shared = _thread_map()
+    base = _offsets[(view, histogram)]
+    for index, amount in ((base + bisect_left(buckets, value), 1), (base + len(buckets) + 1, value), (base + len(buckets) + 2, 1)):
+        struct.pack_into("d", shared, index * SLOT, struct.unpack_from("d", shared, index * SLOT)[0] + amount)
+
+
+def increment(counter, labels, amount=1):
+    """
+    Adds to a counter.
+
+    Parameters:
+    - `counter` - Name from `COUNTERS`.
+    - `labels` - Tuple of label values, in the counter's label order; unknown combinations are ignored.
+    - `amount` - Added to the counter.
+    """
+
+    index = _offsets.get((counter, labels))
+    if index is None:
+        return
+    shared = _thread_map()
+    struct.pack_into("d", shared, index * SLOT, struct.unpack_from("d", shared, index * SLOT)[0] + amount)
+
+
+def _sum_files(paths):
+    totals = array("d", [0.0]) * FILE_SLOTS
+    for path in paths:
+        try:
+            with open(path, "rb") as handle:
+                values = array("d")
+                values.fromstring(handle.read())
+        except IOError:
+            continue # Folded away by `retire()` meanwhile
+        if len(values) != FILE_SLOTS:
+            continue # Half-created file
+        for index, value in enumerate(values):
+            totals[index] += value
+    return totals
+
+
+def _paths():
+    return glob.glob(os.path.join(metrics_dir(), "metrics-v{}-*.bin".format(LAYOUT_VERSION)))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM # exists, but isn't ours
+    return True
+
+
+def collect():
+    """
+    Sums every worker's file into one array of `FILE_SLOTS` floats, first
+    retiring the files of processes that are gone (killed, or exited without
+    running `atexit` handlers) so they don't pile up.
+    """
+
+    pids = set()
+    for path in _paths():
+        pid = os.path.basename(path).split("-")[2]
+        if pid.isdigit():
+            pids.add(int(pid))
+    for pid in pids:
+        if not _alive(pid):
+            retire(pid)
+    return _sum_files(_paths())
+
+
+def retire(pid):
+    """
+    Folds the files of an exited process into a single "retired" file, so
+    recycled and restarted workers don't pile up files for `collect()` to read.
+    Called by every process as it exits, by `serve_prefork` as it reaps its
+    workers, and by `collect()` for processes that died; a lock file keeps two
+    processes from folding the same files.
+
+    The retired file is replaced before the process's files are removed, so a
+    scrape in between may count that process twice.
+    """
+
+    directory = metrics_dir()
+    if not os.path.isdir(directory):
+        return
+    with open(os.path.join(directory, "metrics-v{}.lock".format(LAYOUT_VERSION)), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        paths = glob.glob(os.path.join(directory, "metrics-v{}-{}-*.bin".format(LAYOUT_VERSION, pid)))
+        if not paths:
+            return
+        retired = os.path.join(directory, "metrics-v{}-retired.bin".format(LAYOUT_VERSION))
+        totals = _sum_files(paths + [retired])
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(handle, "wb") as temp:
+            temp.write(totals.tostring())
+        os.rename(temp_path, retired)
+        for path in paths:
+            os.remove(path)
+
+
+def _number(value):
+    return "{:.0f}".format(value) if value == int(value) else repr(value)
+
+
+def render():
+    """Returns every histogram in Prometheus text exposition format."""
+
+    totals = collect()
+    lines = []
+    for name, help_text, buckets in HISTOGRAMS:
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} histogram".format(name))
+        for view in VIEWS:
+            base = _offsets[(view, name)]
+            cumulative = 0.0
+            for index, bound in enumerate(list(buckets) + ["+Inf"]):
+                cumulative += totals[base + index]
+                lines.append('{}_bucket{{view="{}",le="{}"}} {}'.format(name, view, bound, _number(cumulative)))
+            lines.append('{}_sum{{view="{}"}} {}'.format(name, view, _number(totals[base + len(buckets) + 1])))
+            lines.append('{}_count{{view="{}"}} {}'.format(name, view, _number(totals[base + len(buckets) + 2])))
+    for name, help_text, labels, values in COUNTERS:
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} counter".format(name))
+        for value in values:
+            label_text = ",".join('{}="{}"'.format(label, part) for label, part in zip(labels, value))
+            lines.append("{}{{{}}} {}".format(name, label_text, _number(totals[_offsets[(name, value)]])))
+    return "\n".join(lines) + "\n"
+
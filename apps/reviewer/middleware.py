@@ -0,0 +1,188 @@
+"""Request middleware for the reviewer app."""
+
+import cProfile
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.utils import CursorWrapper, CursorDebugWrapper
+from django.http import HttpResponse
+from django.template.backends.django import Template
+
+from . import admission # per-process concurrency limits
+from . import metrics # shared-memory request histograms
+from . import profiling # profile dumps and stack sampler
+
+_local = threading.local()
+
+
+class TimedCursorMixin(object):
+    """Adds the time spent executing SQL to the current request's total."""
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return super(TimedCursorMixin, self).execute(sql, params)
+        finally:
+            _local.sql_time = getattr(_local, "sql_time", 0.0) + time.time() - start
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return super(TimedCursorMixin, self).executemany(sql, param_list)
+        finally:
+            _local.sql_time = getattr(_local, "sql_time", 0.0) + time.time() - start
+
+class TimedCursorWrapper(TimedCursorMixin, CursorWrapper):
+    pass
+
+class TimedCursorDebugWrapper(TimedCursorMixin, CursorDebugWrapper):
+    pass
+
+
+def _instrument_connections():
+    """Makes this thread's database connections hand out timed cursors (once per connection)."""
+
+    for connection in connections.all():
+        if not getattr(connection, "timed_cursors", False):
+            connection.make_cursor = lambda cursor, connection=connection: TimedCursorWrapper(cursor, connection)
+            connection.make_debug_cursor = lambda cursor, connection=connection: TimedCursorDebugWrapper(cursor, connection)
+            connection.timed_cursors = True
+
+
+def _instrument_template_rendering():
+    """
+    Wraps Django template rendering once per process so the time spent in
+    `render()` calls can be attributed to the current request.
+    """
+
+    original = Template.render
+    if getattr(original, "instrumented", False):
+        return
+
+    def render(self, context=None, request=None):
+        start = time.time()
+        try:
+            return original(self, context, request)
+        finally:
+            _local.render_time = getattr(_local, "render_time", 0.0) + time.time() - start
+
+    render.instrumented = True
+    Template.render = render
+
+
+class MetricsMiddleware(object):
+    """
+    Records request duration, SQL time, template render time and response size
+    per resolved view into the histograms in `metrics.py` (served at `/metrics`).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        _instrument_template_rendering()
+
+    def __call__(self, request):
+        start = time.time()
+        _instrument_connections()
+        _local.sql_time = 0.0
+        _local.render_time = 0.0
+
+        response = self.get_response(request)
+
+        view = getattr(request, "metrics_view", "other")
+        metrics.observe(view, "reviewer_request_duration_seconds", time.time() - start)
+        metrics.observe(view, "reviewer_request_sql_seconds", _local.sql_time)
+        metrics.observe(view, "reviewer_request_render_seconds", _local.render_time)
+        if response.streaming:
+            size = int(response.get("Content-Length", 0))
+        else:
+            size = len(response.content)
+        metrics.observe(view, "reviewer_response_size_bytes", size)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.metrics_view = view_func.__name__
+
+
+class AdmissionMiddleware(object):
+    """
+    Limits concurrent requests per route class and sheds the excess with a
+    503 + `Retry-After` instead of letting it queue up (see `admission.py`).
+
+    Comes right after `MetricsMiddleware`, so time spent waiting for a slot
+    shows up in the request duration histograms.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        route = admission.route_class(request)
+        deadline = admission.arrival_time(request) + settings.ADMISSION_QUEUE_DEADLINE
+        gate = admission.gate()
+        shed = gate.enter(route, deadline)
+        if shed is not None:
+            metrics.increment("reviewer_admission_shed_total", (route, shed))
+            response = HttpResponse("The server is busy. Please try again shortly.", status=503, content_type="text/plain; charset=utf-8")
+            response["Retry-After"] = str(settings.ADMISSION_RETRY_AFTER)
+            return response
+        try:
+            return self.get_response(request)
+        finally:
+            gate.leave(route)
+
+
+class ProfilingMiddleware(object):
+    """
+    Profiles selected requests and writes the dumps described in `profiling.py`.
+
+    A request is profiled when:
+    - a staff user (`settings.PROFILING_STAFF_USER_IDS`) sends an `X-Profile`
+    header or a `profile` query parameter; the value may name the mode
+    ("cprofile" or "sampler"), or
+    - it is picked by 1-in-`settings.PROFILING_SAMPLE_RATE` sampling (0 turns
+    sampling off); sampled requests use `settings.PROFILING_MODE`.
+
+    Must come after `SessionMiddleware`, which it needs to recognise staff.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        mode = self.requested_mode(request)
+        if mode is None:
+            return self.get_response(request)
+
+        if mode == "cprofile":
+            profiler = cProfile.Profile()
+            response = profiler.runcall(self.get_response, request)
+            profiler.dump_stats(profiling.dump_path(self.view_name(request), request.path, "prof"))
+        else:
+            sampler = profiling.StackSampler(threading.current_thread().ident, settings.PROFILING_SAMPLE_INTERVAL)
+            sampler.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                sampler.stop()
+            sampler.write(profiling.dump_path(self.view_name(request), request.path, "collapsed"))
+        profiling.rotate()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.profile_view = view_func.__name__
+
+    def view_name(self, request):
+        return getattr(request, "profile_view", "unresolved")
+
+    def requested_mode(self, request):
+        """Returns the profiling mode for this request, or None to not profile it."""
+
+        asked = request.META.get("HTTP_X_PROFILE") or request.GET.get("profile")
+        if asked and request.session.get("user_id") in settings.PROFILING_STAFF_USER_IDS:
+            return asked if asked in profiling.MODES else settings.PROFILING_MODE
+        if settings.PROFILING_SAMPLE_RATE and random.randrange(settings.PROFILING_SAMPLE_RATE) == 0:
+            return settings.PROFILING_MODE
+        return None
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-19 10:45
+from __future__ import unicode_literals
+
+import math
+from datetime import datetime
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+# Frozen copies of `leaderboard.py`'s constants as of this migration:
+DECAY_RATE = math.log(2) / (7 * 24 * 60 * 60)
+EPOCH = datetime(2017, 1, 1, tzinfo=timezone.utc)
+PRIOR_WEIGHT = 5
+BOARD_SIZE = 10
+
+
+def add_log(score, exponent):
+    if score is None:
+        return exponent
+    high, low = max(score, exponent), min(score, exponent)
+    return high + math.log1p(math.exp(low - high))
+
+
+def score_books(apps, schema_editor):
+    """Fills `BookScore` and `TopRatedBook` from existing reviews."""
+
+    BookScore = apps.get_model('reviewer', 'BookScore')
+    TopRatedBook = apps.get_model('reviewer', 'TopRatedBook')
+    scores = {}
+    for book_id, rating, created_at in apps.get_model('reviewer', 'Review').objects.values_list('book_id', 'rating', 'created_at').iterator():
+        count, total, trending_score = scores.get(book_id, (0, 0, None))
+        scores[book_id] = (count + 1, total + rating, add_log(trending_score, DECAY_RATE * (created_at - EPOCH).total_seconds()))
+    BookScore.objects.bulk_create([BookScore(book_id=book_id, review_count=book_count, rating_sum=book_total, trending_score=book_score) for book_id, (book_count, book_total, book_score) in scores.items()], batch_size=500)
+
+    reviews = sum(book_count for book_count, book_total, book_score in scores.values())
+    if not reviews:
+        return
+    mean = float(sum(book_total for book_count, book_total, book_score in scores.values())) / reviews
+    ranked = sorted(((book_total + PRIOR_WEIGHT * mean) / (book_count + PRIOR_WEIGHT), book_count, book_id) for book_id, (book_count, book_total, book_score) in scores.items())
+    TopRatedBook.objects.bulk_create([TopRatedBook(rank=rank, book_id=book_id, score=score, review_count=book_count) for rank, (score, book_count, book_id) in enumerate(reversed(ranked[-BOARD_SIZE:]))])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviewer', '0002_recommendations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookScore',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='reviewer.Book')),
+                ('review_count', models.IntegerField(default=0)),
+                ('rating_sum', models.IntegerField(default=0)),
+                ('trending_score', models.FloatField(blank=True, db_index=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TopRatedBook',
+            fields=[
+                ('rank', models.PositiveSmallIntegerField(primary_key=True, serialize=False)),
+                ('score', models.FloatField()),
+                ('review_count', models.IntegerField()),
+                ('refreshed_at', models.DateTimeField(auto_now=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='reviewer.Book')),
+            ],
+        ),
+        migrations.RunPython(score_books, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-19 10:50
+from __future__ import unicode_literals
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Frozen copies of `titles.normalize_title()` and `titles.trigrams()` as of this
+# migration, so later changes to the live rules don't change what it does:
+ARTICLES = ("the", "a", "an")
+NON_ALPHANUMERIC_RE = re.compile(r"[\W_]+", re.U)
+TRAILING_ARTICLE_RE = re.compile(r",\s*(?:{})\s*$".format("|".join(ARTICLES)), re.I | re.U)
+TITLE_KEY_LENGTH = 100
+
+
+def normalize_title(title):
+    title = unicodedata.normalize("NFKD", "{}".format(title))
+    title = "".join(char for char in title if not unicodedata.combining(char))
+    title = TRAILING_ARTICLE_RE.sub("", title).lower()
+    words = NON_ALPHANUMERIC_RE.sub(" ", title).split()
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+    return " ".join(words)
+
+
+def trigrams(key):
+    padded = "  {} ".format(key)
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def index_titles(apps, schema_editor):
+    """
+    Fills in title keys and trigrams for existing books.
+
+    Books that turn out to be duplicates (same author and key) are left alone:
+    all but the oldest get their id appended to the key, so 0006's unique
+    constraint holds, until `python manage.py merge_duplicate_books` folds them
+    into the oldest copy and stores their real keys.
+    """
+
+    Book = apps.get_model('reviewer', 'Book')
+    BookTrigram = apps.get_model('reviewer', 'BookTrigram')
+    seen = set()
+    for book in Book.objects.order_by('id').iterator():
+        key = normalize_title(book.title)
+        book.title_key = key
+        if (book.author_id, key) in seen:
+            suffix = " #{}".format(book.id) # duplicate, waiting for `merge_duplicate_books`
+            book.title_key = key[:TITLE_KEY_LENGTH - len(suffix)] + suffix
+        seen.add((book.author_id, key))
+        book.save(update_fields=['title_key'])
+        BookTrigram.objects.bulk_create([BookTrigram(book_id=book.id, trigram=gram) for gram in trigrams(key)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviewer', '0004_job_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookTrigram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(max_length=3)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='title_key',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='booktrigram',
+            name='book',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='reviewer.Book'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='booktrigram',
+            unique_together=set([('trigram', 'book')]),
+        ),
+        migrations.RunPython(index_titles, migrations.RunPython.noop),
+    ]
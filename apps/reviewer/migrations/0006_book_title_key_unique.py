@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-19 10:50
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviewer', '0005_book_title_keys'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='book',
+            unique_together=set([('author', 'title_key')]),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-19 10:57
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviewer', '0006_book_title_key_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedReview',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('description', models.CharField(max_length=500)),
+                ('rating', models.IntegerField()),
+                ('created_at', models.DateTimeField(db_index=True)),
+                ('updated_at', models.DateTimeField()),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='reviewer.Book')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='reviewer.User')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='archivedreview',
+            index_together=set([('book', 'created_at')]),
+        ),
+    ]
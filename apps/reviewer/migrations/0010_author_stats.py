@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-19 11:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Sum
+
+
+def count_author_stats(apps, schema_editor):
+    """Fills `AuthorStats` from existing books and (hot and archived) reviews."""
+
+    AuthorStats = apps.get_model('reviewer', 'AuthorStats')
+    stats = {}
+    for row in apps.get_model('reviewer', 'Book').objects.values('author_id').annotate(books=Count('id')).order_by():
+        stats[row['author_id']] = AuthorStats(author_id=row['author_id'], book_count=row['books'])
+    for name in ('Review', 'ArchivedReview'):
+        for row in apps.get_model('reviewer', name).objects.values('book__author_id').annotate(reviews=Count('id'), ratings=Sum('rating')).order_by():
+            author_stats = stats.setdefault(row['book__author_id'], AuthorStats(author_id=row['book__author_id']))
+            author_stats.review_count += row['reviews']
+            author_stats.rating_sum += row['ratings']
+    AuthorStats.objects.bulk_create(stats.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reviewer', '0009_api_tokens'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuthorStats',
+            fields=[
+                ('author', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='reviewer.Author')),
+                ('book_count', models.IntegerField(default=0)),
+                ('review_count', models.IntegerField(default=0)),
+                ('rating_sum', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_author_stats, migrations.RunPython.noop),
+    ]
@@ -1,14 +1,25 @@
 from __future__ import unicode_literals
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, Q, F, Sum
+from django.utils import timezone
+from datetime import timedelta
+import binascii
+import json
+import operator
+import os
 import re # regex
+from titles import normalize_title, trigrams, similarity # title keys for duplicate-book detection
+from pkcache import PkCacheMixin # cached lookups by primary key
+import singleflight # cached book pages
 import bcrypt # grabs `bcrypt` module for encrypting and decrypting passwords
 
-class UserManager(models.Manager):
+class UserManager(PkCacheMixin, models.Manager):
     """
     Extends `Manager` methods to add validation and creation functions.
 
     Parameters:
+    - `PkCacheMixin` - Serves `get(id=...)` and `in_bulk()` from the cache (see `pkcache.py`).
     - `models.Manager` - Gives us access to the `Manager` method to which we
     append additional custom methods.
 
@@ -225,6 +236,12 @@ class ReviewManager(models.Manager):
     - `validate(self, **kwargs)` - Accepts a dictionary list of
     book review form arguments. Either returns errors list if validation fails, or
     returns newly created book.
+    - `add_review(self, **kwargs)` - Accepts a dictionary list of book page review
+    form arguments. Either returns errors list if validation fails, or returns the
+    newly created review.
+    - `destroy(self, id)` - Deletes a review (hot or archived) by id and returns the book it belonged to.
+    - `add_reviews_batch(self, user, items)` - Validates and creates many reviews
+    at once (see `views.api_reviews_batch`); returns one result per item.
     """
 
     def validate(self, **kwargs):
@@ -244,7 +261,8 @@ class ReviewManager(models.Manager):
         If existing author detected:
         ---> Get author.
         If validations above pass:
-        ---> Check if book title already exist for author.
+        ---> Unless confirmed as a new book, suggest existing books with similar titles (error if any).
+        ---> Check if book title (normalized, see `titles.py`) already exist for author.
         -------> If so, create new review for existing book.
         -------> Else, create new review for new book, and add new book to existing author.
         Return review if successful. Return errors if not.
@@ -274,6 +292,24 @@ class ReviewManager(models.Manager):
         if len(kwargs["book"]) > 100:
             errors.append('Title must be less than 100 characters.')
 
+        #----------------------#
+        #---- DID YOU MEAN ----#
+        #----------------------#
+        # Unless the user already confirmed this is a new book, point out existing books with similar titles
+        # ("the shining " or "Shining, The" for "The Shining"), so reviews don't get split across duplicates:
+        if len(errors) == 0 and not kwargs.get("confirm_new_book"):
+            exact_match = len(kwargs["add_author"]) == 0 and Book.objects.filter(author__id=kwargs["author"], title_key=normalize_title(kwargs["book"])).exists()
+            if not exact_match:
+                suggestions = Book.objects.suggest(kwargs["book"])
+                if len(suggestions) > 0:
+                    print "Similar book titles found..."
+                    titles = ", ".join('"{}" by {} {}'.format(book.title, book.author.first_name, book.author.last_name) for book in suggestions)
+                    errors.append('Did you mean {}? If so, pick that author and title. If not, check "This is a new book" and submit again.'.format(titles))
+                    errors = {
+                        "errors": errors,
+                    }
+                    return errors
+
         #------------------------#
         #---- IF NEW AUTHOR  ----#
         #------------------------#
@@ -302,8 +338,7 @@ class ReviewManager(models.Manager):
                     kwargs["author"] = Author(first_name=author[0], last_name=author[1])
                     kwargs["author"].save()
                     # Create new book with new author:
-                    new_author_book = Book(title=kwargs["book"], author=kwargs["author"])
-                    new_author_book.save()
+                    self._create_book(kwargs["book"], kwargs["author"])
                 else:
                     # If existing author detected, create error:
                     print "Error, Existing author detected, validation failed."
@@ -328,28 +363,28 @@ class ReviewManager(models.Manager):
             # Check if book already exists for author -- if so create, review:
             print "Checking if book title already exists for author..."
 
-            try:
-                if Book.objects.get(title=kwargs["book"]) in kwargs["author"].book_set.all():
-                    #----------------------------------------#
-                    #---- EXISTING BOOK, EXISTING AUTHOR ----#
-                    #----------------------------------------#
-                    print "Book already exists for author..."
-                    print "Adding review for existing book..."
-                    # Create new review for existing book:
-                    add_book_review = Review(description=kwargs["description"], user=User.objects.get(id=kwargs["user_id"]), book=Book.objects.get(title=kwargs["book"]), rating=kwargs["rating"])
-                    add_book_review.save()
-                    # Send back review for existing book:
-                    return add_book_review
-            except Book.DoesNotExist:
+            # Titles are compared by normalized key, so "the shining " finds "The Shining":
+            existing_book = Book.objects.find_existing(kwargs["book"], kwargs["author"])
+            if existing_book:
+                #----------------------------------------#
+                #---- EXISTING BOOK, EXISTING AUTHOR ----#
+                #----------------------------------------#
+                print "Book already exists for author..."
+                print "Adding review for existing book..."
+                # Create new review for existing book:
+                add_book_review = Review(description=kwargs["description"], user=User.objects.get(id=kwargs["user_id"]), book=existing_book, rating=kwargs["rating"])
+                self._save_review(add_book_review) # saves and queues background updates together
+                # Send back review for existing book:
+                return add_book_review
+            else:
                 #-----------------------------------#
                 #---- NEW BOOK, EXISTING AUTHOR ----#
                 #-----------------------------------#
                 # If book does not exist for author, create book then create review:
-                new_book = Book(title=kwargs["book"], author=kwargs["author"])
-                new_book.save()
+                new_book = self._create_book(kwargs["book"], kwargs["author"])
                 # Create review & Save review:
                 new_book_review = Review(description=kwargs["description"], user=User.objects.get(id=kwargs["user_id"]), book=new_book, rating=kwargs["rating"],)
-                new_book_review.save()
+                self._save_review(new_book_review) # saves and queues background updates together
                 # Send back review for newly added book:
                 return new_book_review
         else:
@@ -389,7 +424,7 @@ class ReviewManager(models.Manager):
         if len(errors) == 0:
             # Create new review for the book and send back:
             add_review = Review(description=kwargs["description"], user=User.objects.get(id=kwargs["user_id"]), book=Book.objects.get(id=kwargs["book_id"]), rating=kwargs["rating"])
-            add_review.save()
+            self._save_review(add_review) # saves and queues background updates together
             return add_review
         else:
             # Format for controller and send back errors:
@@ -398,7 +433,435 @@ class ReviewManager(models.Manager):
             }
             return errors
 
+    def destroy(self, id):
+        """Deletes a review by id and returns the `Book` it belonged to (archived reviews too, see `archive.py`)."""
+
+        review = Review.objects.select_related("book").filter(id=id).first()
+        if review is None:
+            review = ArchivedReview.objects.select_related("book").get(id=id)
+        # Delete and queue background updates in one transaction (outbox pattern):
+        with transaction.atomic():
+            review.delete()
+            AuthorStats.objects.adjust(review.book.author_id, reviews=-1, ratings=-int(review.rating))
+            BookScore.objects.adjust(review.book_id, reviews=-1, ratings=-int(review.rating))
+            Job.objects.enqueue("review_changed", self._change_payload(review, added=False))
+            self._queue_snapshot(review.book_id)
+        return review.book
+
+    def add_reviews_batch(self, user, items):
+        """
+        Validates and creates a batch of reviews by `user` in one transaction.
+
+        Items are validated in memory with the same rules as `validate()` and
+        `add_review()`. Authors are looked up with one query (by id or name),
+        then books with one more (by id, or by author id and normalized title);
+        books and authors that don't exist yet are created one by one, then
+        every valid review is inserted with a single `bulk_create`, and their
+        background jobs with one more.
+
+        Parameters:
+        - `user` - `User` the reviews are posted as.
+        - `items` - List of dictionaries, each with `description`, `rating` and
+        either `book_id`, or a `book` title plus `author_id` or `author` ("First Last").
+
+        Returns a list with, for each item in order, either
+        `{"review_id": ..., "book_id": ...}` or `{"errors": [...]}`.
+        """
+
+        results = [self._validate_batch_item(item) for item in items]
+        valid = [result for result in results if "errors" not in result]
+
+        # Resolve every referenced author in one query (the oldest one, for names several authors share):
+        author_ids = set(result["author_id"] for result in valid if "author_id" in result)
+        author_names = set(result["author_name"] for result in valid if "author_name" in result)
+        authors = {} # ("first", "last") or author id -> `Author`
+        if author_ids or author_names:
+            named = [Q(first_name=first_name, last_name=last_name) for first_name, last_name in author_names]
+            for author in Author.objects.filter(reduce(operator.or_, named, Q(id__in=author_ids))).order_by("id"):
+                authors[author.id] = author
+                authors.setdefault((author.first_name, author.last_name), author)
+
+        # ...then every referenced book in one more:
+        book_ids = set(result["book_id"] for result in valid if "book_id" in result)
+        title_keys = set(result["title_key"] for result in valid if "title_key" in result)
+        books = Book.objects.select_related("author").filter(Q(id__in=book_ids) | Q(title_key__in=title_keys, author_id__in=set(author.id for author in authors.values()))) if valid else []
+        books_by_id = dict((book.id, book) for book in books)
+        books_by_author_id = dict(((book.author_id, book.title_key), book) for book in books)
+
+        with transaction.atomic():
+            reviews = []
+            for result in valid:
+                if "book_id" in result:
+                    book = books_by_id.get(result["book_id"])
+                    if book is None:
+                        result["errors"] = ["Book not found."]
+                        continue
+                else:
+                    author = authors.get(result.get("author_id", result.get("author_name")))
+                    if author is None:
+                        if "author_id" in result:
+                            result["errors"] = ["Author not found."]
+                            continue
+                        author = authors[result["author_name"]] = Author.objects.create(first_name=result["author_name"][0], last_name=result["author_name"][1])
+                    book = books_by_author_id.get((author.id, result["title_key"]))
+                    if book is None:
+                        book = books_by_author_id[(author.id, result["title_key"])] = self._create_book(result["title"], author)
+                result["review"] = Review(description=result["description"], user=user, book=book, rating=result["rating"])
+                reviews.append(result["review"])
+
+            max_id = self.aggregate(models.Max("id"))["id__max"] or 0
+            self.bulk_create(reviews)
+            by_author, by_book = {}, {}
+            for review in reviews:
+                count, total = by_author.get(review.book.author_id, (0, 0))
+                by_author[review.book.author_id] = (count + 1, total + review.rating)
+                count, total = by_book.get(review.book_id, (0, 0))
+                by_book[review.book_id] = (count + 1, total + review.rating)
+            for author_id, (count, total) in by_author.items():
+                AuthorStats.objects.adjust(author_id, reviews=count, ratings=total)
+            for book_id, (count, total) in by_book.items():
+                BookScore.objects.adjust(book_id, reviews=count, ratings=total)
+            if reviews and reviews[0].pk is None:
+                # The backend can't return ids from bulk inserts (e.g. SQLite): read them back. This transaction holds
+                # the write lock, so this user's newest rows are exactly the ones just inserted, in insertion order.
+                ids = self.filter(user=user, id__gt=max_id).order_by("-id").values_list("id", flat=True)[:len(reviews)]
+                for review, id in zip(reviews, reversed(list(ids))):
+                    review.id = id
+            Job.objects.enqueue_many("review_changed", [self._change_payload(review, added=True) for review in reviews])
+            Job.objects.enqueue_many("fan_out_review", [{"review_id": review.id, "user_id": review.user_id} for review in reviews])
+            for book_id in set(review.book_id for review in reviews):
+                self._queue_snapshot(book_id)
+
+        print "Batch of {} reviews: {} created.".format(len(items), len(reviews))
+        return [{"errors": result["errors"]} if "errors" in result else {"review_id": result["review"].id, "book_id": result["review"].book_id} for result in results]
+
+    def _validate_batch_item(self, item):
+        """Checks one `add_reviews_batch()` item without touching the database; returns its cleaned fields or `{"errors": [...]}`."""
+
+        errors = []
+        if not isinstance(item, dict):
+            return {"errors": ["Each review must be a JSON object."]}
+        for field, label in (("description", "Review"), ("book", "Book title"), ("author", "Author")):
+            if item.get(field) is not None and not isinstance(item[field], basestring):
+                errors.append('{} must be text.'.format(label))
+        if len(errors) > 0:
+            return {"errors": errors}
+        description = item.get("description") or ""
+        title = item.get("book") or ""
+        cleaned = {"description": description}
+
+        if len(description) < 1:
+            errors.append('A review is required.')
+        if len(description) > 500:
+            errors.append('Review must be less than 500 characters.')
+        rating = item.get("rating")
+        try:
+            if isinstance(rating, bool) or (isinstance(rating, float) and not rating.is_integer()):
+                raise ValueError(rating) # `int()` would take True as 1 and 4.9 as 4
+            cleaned["rating"] = int(rating)
+        except (TypeError, ValueError):
+            cleaned["rating"] = None
+        if cleaned["rating"] not in range(1, 6):
+            errors.append('Rating must be a whole number from 1 to 5.')
+
+        if item.get("book_id") is not None:
+            try:
+                cleaned["book_id"] = int(item["book_id"])
+            except (TypeError, ValueError):
+                errors.append('Book id must be a number.')
+        elif len(title) < 1:
+            errors.append('A book title and book review is required.')
+        elif len(title) > 100:
+            errors.append('Title must be less than 100 characters.')
+        else:
+            cleaned["title"] = title
+            cleaned["title_key"] = normalize_title(title)
+            if item.get("author_id") is not None:
+                try:
+                    cleaned["author_id"] = int(item["author_id"])
+                except (TypeError, ValueError):
+                    errors.append('Author id must be a number.')
+            else:
+                author = (item.get("author") or "").split()
+                if len(author) != 2:
+                    errors.append('Author may contain a first and last name only. Middle names or initials are not allowed.')
+                else:
+                    cleaned["author_name"] = tuple(author)
+
+        if len(errors) > 0:
+            return {"errors": errors}
+        return cleaned
+
+    def _create_book(self, title, author):
+        """Creates a book and counts it in its author's `AuthorStats` (one at a time: `Book.save()` also writes its title trigrams)."""
+
+        with transaction.atomic():
+            book = Book(title=title, author=author)
+            book.save()
+            AuthorStats.objects.adjust(author.id, books=1)
+        return book
+
+    def _save_review(self, review):
+        """
+        Saves a review and queues the updates to data derived from it (leaderboards, etc.).
+
+        The job rows are written in the same transaction as the review (outbox
+        pattern), so the updates happen if and only if the review is committed,
+        and `run_workers` applies them off the request path. Followers' feeds
+        get their own job so a failure there never replays leaderboard updates.
+        """
+
+        with transaction.atomic():
+            review.save()
+            AuthorStats.objects.adjust(review.book.author_id, reviews=1, ratings=int(review.rating))
+            BookScore.objects.adjust(review.book_id, reviews=1, ratings=int(review.rating))
+            Job.objects.enqueue("review_changed", self._change_payload(review, added=True))
+            Job.objects.enqueue("fan_out_review", {"review_id": review.id, "user_id": review.user_id})
+            self._queue_snapshot(review.book_id)
+
+    def _queue_snapshot(self, book_id):
+        """
+        Queues a re-render of the book's logged-out page (see `snapshots.py`);
+        one waiting job per book is enough. Its cached logged-in pages and the
+        dashboard's latest reviews (see `helper.book_page_data()` and
+        `helper.dashboard_lists()`) are dropped once the write commits.
+        """
+
+        Job.objects.enqueue("snapshot_book", {"book_id": book_id}, dedupe_key="snapshot_book:{}".format(book_id))
+        transaction.on_commit(lambda: singleflight.bump("book:{}".format(int(book_id))))
+        transaction.on_commit(lambda: singleflight.bump("dashboard"))
 
+    def _change_payload(self, review, added):
+        """Builds the `review_changed` job payload; carries everything handlers need once the row is gone."""
+
+        return {
+            "review_id": review.id,
+            "book_id": review.book_id,
+            "user_id": review.user_id,
+            "rating": int(review.rating),
+            "created_at": review.created_at.isoformat(),
+            "added": added,
+        }
+
+class JobManager(models.Manager):
+    """
+    Extends `Manager` methods to add background job queueing.
+
+    Parameters:
+    - `models.Manager` - Gives us access to the `Manager` method to which we
+    append additional custom methods.
+
+    Functions:
+    - `enqueue(self, kind, payload, dedupe_key=None, delay=0)` - Queues a job for `run_workers`.
+    - `enqueue_many(self, kind, payloads, delay=0)` - Queues many jobs of one kind at once.
+    """
+
+    def enqueue(self, kind, payload, dedupe_key=None, delay=0):
+        """
+        Queues a job for the `run_workers` command.
+
+        Call inside the same `transaction.atomic()` block as the write the job
+        belongs to, so the job only exists if the write is committed.
+
+        Parameters:
+        - `kind` - Name of the handler to run (see `tasks.py`).
+        - `payload` - JSON-serializable dictionary handed to the handler.
+        - `dedupe_key` - Optional key; if a job with the same key is still waiting,
+        no new job is queued (e.g. "one regeneration per book is enough").
+        - `delay` - Seconds to wait before the job may run.
+
+        Returns the queued `Job`, or None if it was deduplicated.
+        """
+
+        if dedupe_key is not None and self.filter(dedupe_key=dedupe_key, status=Job.PENDING, locked_by__isnull=True).exists():
+            return None
+        return self.create(kind=kind, payload=json.dumps(payload), dedupe_key=dedupe_key, run_after=timezone.now() + timedelta(seconds=delay))
+
+    def enqueue_many(self, kind, payloads, delay=0):
+        """Queues one job per payload with a single bulk insert (no deduplication); see `enqueue()`."""
+
+        run_after = timezone.now() + timedelta(seconds=delay)
+        self.bulk_create([Job(kind=kind, payload=json.dumps(payload), run_after=run_after) for payload in payloads], batch_size=500)
+
+
+class FollowManager(models.Manager):
+    """
+    Extends `Manager` methods to add following and unfollowing reviewers.
+
+    Parameters:
+    - `models.Manager` - Gives us access to the `Manager` method to which we
+    append additional custom methods.
+
+    Functions:
+    - `follow(self, follower_id, followee_id)` - Either returns errors list if
+    validation fails, or returns the new (or existing) `Follow`.
+    - `unfollow(self, follower_id, followee_id)` - Stops following and clears the
+    followee's reviews from the follower's feed.
+    """
+
+    def follow(self, follower_id, followee_id):
+        """
+        Makes `follower_id` follow `followee_id`.
+
+        The followee's recent reviews are copied into the follower's feed by a
+        `backfill_feed` job queued in the same transaction (see `feed.py`).
+        """
+
+        errors = []
+        if int(follower_id) == int(followee_id):
+            errors.append("You can't follow yourself.")
+        elif not User.objects.filter(id=followee_id).exists():
+            errors.append("This user does not exist.")
+        if len(errors) > 0:
+            return {
+                "errors": errors,
+            }
+
+        with transaction.atomic():
+            follow, created = self.get_or_create(follower_id=follower_id, followee_id=followee_id)
+            if created:
+                Job.objects.enqueue("backfill_feed", {"follower_id": follow.follower_id, "followee_id": follow.followee_id})
+        return follow
+
+    def unfollow(self, follower_id, followee_id):
+        """Stops `follower_id` following `followee_id`; returns True if they were following."""
+
+        with transaction.atomic():
+            deleted, _ = self.filter(follower_id=follower_id, followee_id=followee_id).delete()
+            FeedEntry.objects.filter(owner_id=follower_id, review__user_id=followee_id).delete()
+        return deleted > 0
+
+class AuthorManager(PkCacheMixin, models.Manager):
+    """
+    Serves `Author` lookups by id from the cache.
+
+    Parameters:
+    - `PkCacheMixin` - Serves `get(id=...)` and `in_bulk()` from the cache (see `pkcache.py`).
+    - `models.Manager` - Gives us access to the `Manager` method to which we
+    append additional custom methods.
+    """
+
+class AuthorStatsManager(models.Manager):
+    """
+    Extends `Manager` methods to keep the per-author aggregates current.
+
+    Parameters:
+    - `models.Manager` - Gives us access to the `Manager` method to which we
+    append additional custom methods.
+
+    Functions:
+    - `adjust(self, author_id, books=0, reviews=0, ratings=0)` - Adds to an
+    author's counters (called by `ReviewManager` inside its write transactions).
+    - `rebuild(self, author_ids=None)` - Recomputes counters from books and reviews.
+    """
+
+    def adjust(self, author_id, books=0, reviews=0, ratings=0):
+        """Adds to an author's book count, review count and rating sum, creating their row if needed."""
+
+        self.get_or_create(author_id=author_id) # survives a concurrent first write for the same author
+        self.filter(author_id=author_id).update(book_count=F("book_count") + books, review_count=F("review_count") + reviews, rating_sum=F("rating_sum") + ratings)
+
+    def rebuild(self, author_ids=None):
+        """
+        Recomputes `AuthorStats` from `Book`, `Review` and `ArchivedReview`.
+
+        For backfills and after bulk changes that skip `ReviewManager` (e.g.
+        `merge_duplicate_books`). Pass `author_ids` to only redo some authors.
+
+        Returns the number of rows written.
+        """
+
+        books = Book.objects.all()
+        reviews = [Review.objects.all(), ArchivedReview.objects.all()]
+        if author_ids is not None:
+            books = books.filter(author_id__in=author_ids)
+            reviews = [queryset.filter(book__author_id__in=author_ids) for queryset in reviews]
+
+        stats = {}
+        for row in books.values("author_id").annotate(books=Count("id")).order_by():
+            stats[row["author_id"]] = AuthorStats(author_id=row["author_id"], book_count=row["books"])
+        for queryset in reviews:
+            for row in queryset.values("book__author_id").annotate(reviews=Count("id"), ratings=Sum("rating")).order_by():
+                author_stats = stats.setdefault(row["book__author_id"], AuthorStats(author_id=row["book__author_id"]))
+                author_stats.review_count += row["reviews"]
+                author_stats.rating_sum += row["ratings"]
+
+        with transaction.atomic():
+            existing = self.all() if author_ids is None else self.filter(author_id__in=author_ids)
+            existing.delete()
+            self.bulk_create(stats.values(), batch_size=500)
+        return len(stats)
+
+class BookScoreManager(models.Manager):
+    """
+    Extends `Manager` methods to keep each book's review counters current.
+
+    Parameters:
+    - `models.Manager` - Gives us access to the `Manager` method to which we
+    append additional custom methods.
+
+    Functions:
+    - `adjust(self, book_id, reviews=0, ratings=0)` - Adds to a book's review
+    count and rating sum (called by `ReviewManager` inside its write
+    transactions, next to `AuthorStats.objects.adjust()`).
+    """
+
+    def adjust(self, book_id, reviews=0, ratings=0):
+        """Adds to a book's review count and rating sum, creating its row if needed."""
+
+        self.get_or_create(book_id=book_id) # survives a concurrent first review of the same book
+        self.filter(book_id=book_id).update(review_count=F("review_count") + reviews, rating_sum=F("rating_sum") + ratings)
+
+class BookManager(PkCacheMixin, models.Manager):
+    """
+    Extends `Manager` methods to add duplicate-book detection.
+
+    Parameters:
+    - `PkCacheMixin` - Serves `get(id=...)` and `in_bulk()` from the cache (see `pkcache.py`).
+    - `models.Manager` - Gives us access to the `Manager` method to which we
+    append additional custom methods.
+
+    Functions:
+    - `find_existing(self, title, author)` - Returns the author's book whose title
+    normalizes to the same key as `title`, or None.
+    - `suggest(self, title, limit=3, threshold=0.4)` - Returns books with titles
+    similar to `title`, most similar first ("did you mean...").
+    - `index_trigrams(self, book)` - Rewrites a book's `BookTrigram` rows.
+    """
+
+    def find_existing(self, title, author):
+        """Returns `author`'s book with the same title key as `title`, or None."""
+
+        return self.filter(author=author, title_key=normalize_title(title)).first()
+
+    def suggest(self, title, limit=3, threshold=0.4):
+        """
+        Finds books whose titles look like `title`.
+
+        Counts shared trigrams with one grouped query over the `BookTrigram`
+        index, then re-scores the best candidates exactly.
+
+        Parameters:
+        - `title` - Title as typed by the user.
+        - `limit` - Most suggestions returned.
+        - `threshold` - Minimum trigram similarity (0 to 1).
+        """
+
+        key = normalize_title(title)
+        if not key:
+            return []
+        candidates = BookTrigram.objects.filter(trigram__in=trigrams(key)).values("book").annotate(shared=Count("id")).order_by("-shared")[:limit * 10]
+        books = self.select_related("author").in_bulk([candidate["book"] for candidate in candidates])
+        scored = [(similarity(key, book.title_key), book) for book in books.values()]
+        scored = [(score, book) for score, book in scored if score >= threshold]
+        scored.sort(key=lambda pair: (-pair[0], pair[1].id))
+        return [book for score, book in scored[:limit]]
+
+    def index_trigrams(self, book):
+        """Rewrites the `BookTrigram` rows of `book` from its title key."""
+
+        BookTrigram.objects.filter(book=book).delete()
+        BookTrigram.objects.bulk_create([BookTrigram(book=book, trigram=gram) for gram in trigrams(book.title_key)])
 
 class User(models.Model):
     """
@@ -412,6 +875,7 @@ class User(models.Model):
     last_name = models.CharField(max_length=50)
     email = models.CharField(max_length=50)
     password = models.CharField(max_length=22)
+    feed_pull = models.BooleanField(default=False) # too many followers to fan out to; followers' feeds pull their reviews instead (see `feed.py`)
     created_at = models.DateTimeField(auto_now_add=True) # DateTimeField is field type for date and time
     updated_at = models.DateTimeField(auto_now=True) # note the `auto_now=True` parameter
     objects = UserManager() # Attaches `UserManager` methods to our `User.objects` object.
@@ -428,6 +892,29 @@ class Author(models.Model):
     last_name = models.CharField(max_length=50)
     created_at = models.DateTimeField(auto_now_add=True) # DateTimeField is field type for date and time
     updated_at = models.DateTimeField(auto_now=True) # note the `auto_now=True` parameter
+    objects = AuthorManager() # Attaches `AuthorManager` methods to our `Author.objects` object.
+
+class AuthorStats(models.Model):
+    """
+    Creates instances of an `AuthorStats`, the running totals behind the author
+    page (`views.author`). Kept current by `ReviewManager` in the same
+    transaction as each book or review write.
+
+    Parameters:
+    -`models.Model` - Django's `models.Model` method allows us to create new models.
+    """
+
+    author = models.OneToOneField(Author, primary_key=True, related_name="stats", on_delete=models.CASCADE)
+    book_count = models.IntegerField(default=0)
+    review_count = models.IntegerField(default=0) # hot and archived reviews of all the author's books
+    rating_sum = models.IntegerField(default=0) # sum of all those ratings, for the mean
+    objects = AuthorStatsManager() # Attaches `AuthorStatsManager` methods to our `AuthorStats.objects` object.
+
+    @property
+    def mean_rating(self):
+        """Mean rating over all the author's reviews, or None without reviews."""
+
+        return float(self.rating_sum) / self.review_count if self.review_count else None
 
 class Book(models.Model):
     """
@@ -438,9 +925,36 @@ class Book(models.Model):
     """
 
     title = models.CharField(max_length=100) # CharField is field type for characters
+    title_key = models.CharField(max_length=100, default="") # normalized title, see `titles.normalize_title()`
     author = models.ForeignKey(Author, on_delete=models.CASCADE) # ties us into an author for the book. if author deleted, books delete too.
     created_at = models.DateTimeField(auto_now_add=True) # DateTimeField is field type for date and time
     updated_at = models.DateTimeField(auto_now=True) # note the `auto_now=True` parameter
+    objects = BookManager() # Attaches `BookManager` methods to our `Book.objects` object.
+
+    class Meta:
+        unique_together = (("author", "title_key"),) # one book per normalized title per author
+
+    def save(self, *args, **kwargs):
+        """Keeps `title_key` and the trigram index in step with `title`."""
+
+        self.title_key = normalize_title(self.title)
+        super(Book, self).save(*args, **kwargs)
+        Book.objects.index_trigrams(self)
+
+class BookTrigram(models.Model):
+    """
+    Creates instances of a `BookTrigram`, one row of the trigram index used to
+    suggest existing books with similar titles (see `BookManager.suggest()`).
+
+    Parameters:
+    -`models.Model` - Django's `models.Model` method allows us to create new models.
+    """
+
+    trigram = models.CharField(max_length=3)
+    book = models.ForeignKey(Book, on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = (("trigram", "book"),) # doubles as the lookup index by trigram
 
 
 class Review(models.Model):
@@ -456,5 +970,182 @@ class Review(models.Model):
     book = models.ForeignKey(Book) # book for review
     rating = models.IntegerField() # user rating between 1-5
     created_at = models.DateTimeField(auto_now_add=True) # DateTimeField is field type for date and time
-    updated_at = models.DateTimeField(auto_now=True) # note the `auto_now=True` parameter
+    updated_at = models.DateTimeField(auto_now=True, db_index=True) # indexed so recommendation refreshes can find recently touched books
     objects = ReviewManager() # Attaches 'ReviewManager' to `Review.objects` methods.
+
+class ArchivedReview(models.Model):
+    """
+    Creates instances of an `ArchivedReview`, a `Review` moved to the cold
+    partition by the `archive_reviews` management command (see `archive.py`).
+
+    Keeps the original review id, so links and deletes keep working, and the
+    original timestamps (set explicitly, not automatically).
+
+    Parameters:
+    -`models.Model` - Django's `models.Model` method allows us to create new models.
+    """
+
+    id = models.IntegerField(primary_key=True) # id the review had in the `Review` table
+    description = models.CharField(max_length=500)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    book = models.ForeignKey(Book, on_delete=models.CASCADE)
+    rating = models.IntegerField()
+    created_at = models.DateTimeField(db_index=True) # copied from the review
+    updated_at = models.DateTimeField() # copied from the review
+
+    class Meta:
+        index_together = (("book", "created_at"),) # paging a book's reviews deep into its history
+
+class ApiToken(models.Model):
+    """
+    Creates instances of an `ApiToken`, the credential a partner integration
+    sends (`Authorization: Token <key>`) to the JSON API. Reviews posted with
+    it are posted as its `user`. Issue one with the `create_api_token` command.
+
+    Parameters:
+    -`models.Model` - Django's `models.Model` method allows us to create new models.
+    """
+
+    key = models.CharField(max_length=40, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE) # account the partner posts as
+    name = models.CharField(max_length=50) # partner name, for humans
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @staticmethod
+    def generate_key():
+        return binascii.hexlify(os.urandom(20)).decode()
+
+class Follow(models.Model):
+    """
+    Creates instances of a `Follow` -- one user following another reviewer.
+
+    Parameters:
+    -`models.Model` - Django's `models.Model` method allows us to create new models.
+    """
+
+    follower = models.ForeignKey(User, related_name="following", on_delete=models.CASCADE) # user whose feed shows the reviews
+    followee = models.ForeignKey(User, related_name="followers", on_delete=models.CASCADE) # reviewer being followed
+    created_at = models.DateTimeField(auto_now_add=True)
+    objects = FollowManager() # Attaches `FollowManager` methods to our `Follow.objects` object.
+
+    class Meta:
+        unique_together = (("follower", "followee"),)
+
+class FeedEntry(models.Model):
+    """
+    Creates instances of a `FeedEntry` -- one review in a follower's feed.
+
+    Written by the fan-out jobs in `feed.py` and capped to the newest
+    `feed.FEED_SIZE` (plus slack) per owner, so reading a feed is one range
+    scan of the (`owner`, `created_at`) index. Entries go with their review when
+    it is deleted or archived.
+
+    Parameters:
+    -`models.Model` - Django's `models.Model` method allows us to create new models.
+    """
+
+    owner = models.ForeignKey(User, related_name="feed_entries", on_delete=models.CASCADE) # user whose feed this is
+    review = models.ForeignKey(Review, related_name="+", on_delete=models.CASCADE)
+    created_at = models.DateTimeField() # copied from the review, for ordering without a join
+
+    class Meta:
+        unique_together = (("owner", "review"),) # fan-out and backfill may race; one entry per review
+        index_together = (("owner", "created_at"),) # the feed read
+
+class BookNeighbor(models.Model):
+    """
+    Creates instances of a `BookNeighbor` -- one precomputed "readers who liked
+    this also liked" recommendation.
+
+    Rows are written by the offline job in `recommender.py` (see the
+    `build_recommendations` management command) and are read back by
+    `views.book` with a single indexed lookup on (`book`, `rank`).
+
+    Parameters:
+    -`models.Model` - Django's `models.Model` method allows us to create new models.
+    """
+
+    book = models.ForeignKey(Book, related_name="neighbors", on_delete=models.CASCADE) # book the recommendation is shown on
+    neighbor = models.ForeignKey(Book, related_name="+", on_delete=models.CASCADE) # book being recommended
+    score = models.FloatField() # cosine similarity or co-rating count
+    rank = models.PositiveSmallIntegerField() # 0 is the closest neighbor
+
+    class Meta:
+        unique_together = (("book", "rank"),) # doubles as the lookup index for `views.book`
+        ordering = ["rank"]
+
+class BookScore(models.Model):
+    """
+    Creates instances of a `BookScore`, the running totals behind the dashboard
+    leaderboards and the author page. The counters are kept current by
+    `ReviewManager` in the same transaction as each review write, like
+    `AuthorStats`; the trending score by the `review_changed` background job
+    (see `leaderboard.py`).
+
+    Parameters:
+    -`models.Model` - Django's `models.Model` method allows us to create new models.
+    """
+
+    book = models.OneToOneField(Book, primary_key=True, on_delete=models.CASCADE) # one row per reviewed book
+    review_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0) # sum of all ratings, for averages
+    trending_score = models.FloatField(null=True, blank=True, db_index=True) # log-space time-decayed score; None when no reviews
+    objects = BookScoreManager() # Attaches `BookScoreManager` methods to our `BookScore.objects` object.
+
+class TopRatedBook(models.Model):
+    """
+    Creates instances of a `TopRatedBook`, one row of the materialized
+    Bayesian-average "top rated" leaderboard. Rewritten by `refresh_leaderboards`.
+
+    Parameters:
+    -`models.Model` - Django's `models.Model` method allows us to create new models.
+    """
+
+    rank = models.PositiveSmallIntegerField(primary_key=True) # 0 is the best rated book
+    book = models.ForeignKey(Book, on_delete=models.CASCADE)
+    score = models.FloatField() # Bayesian average rating
+    review_count = models.IntegerField()
+    refreshed_at = models.DateTimeField(auto_now=True)
+
+class Job(models.Model):
+    """
+    Creates instances of a `Job`, one unit of background work in the local job
+    queue. Jobs are queued with `Job.objects.enqueue()` and run by the
+    `run_workers` management command (see `jobs.py`). Finished jobs are deleted.
+
+    Parameters:
+    -`models.Model` - Django's `models.Model` method allows us to create new models.
+    """
+
+    PENDING = "pending"
+    FAILED = "failed" # gave up after `jobs.MAX_ATTEMPTS`; kept for inspection
+
+    kind = models.CharField(max_length=50) # handler name, see `tasks.py`
+    payload = models.TextField(default="{}") # JSON arguments for the handler
+    dedupe_key = models.CharField(max_length=100, null=True, blank=True, db_index=True) # collapses duplicate waiting jobs
+    status = models.CharField(max_length=10, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now) # pushed back on retries
+    locked_by = models.CharField(max_length=64, null=True, blank=True, db_index=True) # claim token of the worker running it
+    locked_until = models.DateTimeField(null=True, blank=True) # claim expires so crashed workers' jobs get retried
+    last_error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    objects = JobManager() # Attaches `JobManager` methods to our `Job.objects` object.
+
+    class Meta:
+        index_together = (("status", "run_after"),) # the workers' polling query
+
+class RecommendationRun(models.Model):
+    """
+    Creates instances of a `RecommendationRun`, recording each batch run of the
+    recommendation job so the next run can refresh only the books touched since.
+
+    Parameters:
+    -`models.Model` - Django's `models.Model` method allows us to create new models.
+    """
+
+    full = models.BooleanField(default=False) # True if every book was recomputed
+    books_refreshed = models.IntegerField(default=0) # number of books whose neighbors were rewritten
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True) # None until the run completes
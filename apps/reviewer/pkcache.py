@@ -0,0 +1,264 @@
+"""
+Two-tier cache-aside for single-object lookups by primary key.
+
+Managers that mix in `PkCacheMixin` answer `get(pk=...)` / `get(id=...)` and
+`in_bulk(ids)` from:
+
+1. a per-process LRU (`LOCAL_SIZE` entries, each trusted for `LOCAL_TTL`
+seconds), then
+2. the shared Django cache (`SHARED_TTL` seconds), then
+3. the database, filling both tiers on the way back.
+
+Entries hold the row's field values, not the instance, so every lookup gets
+a fresh instance that callers may change freely.
+
+Invalidation: `post_save` / `post_delete` (connected when the manager is
+attached to its model) drop the row from this process's LRU at once, and from
+both tiers when the transaction commits -- a concurrent reader may have cached
+the old row in between. Writes that bypass signals (`QuerySet.update()`, raw
+SQL) must call `bump(model)`, which replaces the model's generation -- part of
+every key -- so all of its cached rows are abandoned at once. Other
+processes' LRUs may serve a changed row for up to `LOCAL_TTL` seconds.
+
+The shared tier must really be shared (see `settings.CACHES`): with a
+per-process cache, invalidations never reach the other processes. When it is
+the database cache, rows skip it -- a cache query costs as much as the lookup
+it would save -- and only the generations go through it.
+
+Lookups are counted per model and answering tier in
+`reviewer_pkcache_lookups_total` on `/metrics`; the local and shared hit
+rates tell whether `LOCAL_SIZE` and the shared cache are big enough.
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.db import BaseDatabaseCache
+from django.db import transaction
+from django.core.exceptions import ValidationError
+from django.db.models.signals import post_save, post_delete
+
+from . import metrics # hit-rate counters
+
+LOCAL_SIZE = 5000 # Rows kept in each process's LRU (all models together)
+LOCAL_TTL = 5 # Seconds a process trusts its own copy (bounds staleness after writes in other processes)
+SHARED_TTL = 300 # Seconds rows live in the shared cache
+
+
+class LocalLRU(object):
+    """A small thread-safe LRU dictionary whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, size=LOCAL_SIZE, ttl=LOCAL_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (expires, value), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            self._entries[key] = entry # most recently used again
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_local = LocalLRU()
+
+
+def shared_tier():
+    """Whether values go to the shared cache; not when it is the database itself."""
+
+    return not isinstance(caches["default"], BaseDatabaseCache)
+
+
+def read_generation(key):
+    """
+    Returns the generation stored in the shared cache under `key`, starting a
+    new one if there is none. Never 0 or any other fixed value: a generation
+    the cache evicted must not bring back values cached under an older one.
+    """
+
+    current = cache.get(key)
+    if current is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        current = cache.get(key) # whichever process added first
+    return current or uuid.uuid4().hex # cache unreachable: share nothing
+
+
+def _label(model):
+    return model._meta.label_lower
+
+
+def _generation_key(model):
+    return "pkcache:gen:{}".format(_label(model))
+
+
+def generation(model):
+    """Returns the model's current generation (cached locally like the rows themselves)."""
+
+    key = _generation_key(model)
+    current = _local.get(key)
+    if current is None:
+        current = read_generation(key)
+        _local.set(key, current)
+    return current
+
+
+def _bump_now(model):
+    cache.set(_generation_key(model), uuid.uuid4().hex, None) # a new value every time, even if two bumps race
+    _local.clear()
+
+
+def bump(model):
+    """Invalidates every cached row of `model`; call after writes that skip signals (e.g. `update()`)."""
+
+    _bump_now(model)
+    transaction.on_commit(lambda: _bump_now(model)) # and again once readers can see the write
+
+
+def _key(model, pk):
+    return "pkcache:{}:{}:{}".format(_label(model), generation(model), pk)
+
+
+def _count(model, tier, amount=1):
+    if amount:
+        metrics.increment("reviewer_pkcache_lookups_total", (model._meta.model_name, tier), amount)
+
+
+def _pack(obj):
+    return tuple(getattr(obj, field.attname) for field in obj._meta.concrete_fields)
+
+
+def _unpack(model, values):
+    return model.from_db("default", [field.attname for field in model._meta.concrete_fields], values)
+
+
+def lookup(model, pks, load):
+    """
+    Returns `{pk: instance}` for the `pks` that exist, trying each tier in turn.
+
+    Parameters:
+    - `model` - Model class.
+    - `pks` - Already normalized primary keys.
+    - `load` - Function taking the missing pks and returning `{pk: instance}` from the database.
+    """
+
+    found = {}
+    keys = dict((_key(model, pk), pk) for pk in pks)
+
+    missing = []
+    for key, pk in keys.items():
+        values = _local.get(key)
+        if values is None:
+            missing.append(key)
+        else:
+            found[pk] = _unpack(model, values)
+    _count(model, "local", len(found))
+    if not missing:
+        return found
+
+    shared = cache.get_many(missing) if shared_tier() else {}
+    for key, values in shared.items():
+        _local.set(key, values)
+        found[keys[key]] = _unpack(model, values)
+    _count(model, "shared", len(shared))
+
+    pending = [keys[key] for key in missing if key not in shared]
+    if pending:
+        loaded = load(pending)
+        rows = dict((_key(model, pk), _pack(obj)) for pk, obj in loaded.items())
+        if shared_tier():
+            cache.set_many(rows, SHARED_TTL)
+        for key, values in rows.items():
+            _local.set(key, values)
+        found.update(loaded)
+        _count(model, "database", len(pending))
+    return found
+
+
+def _drop(model, pk):
+    key = _key(model, pk)
+    _local.delete(key)
+    if shared_tier():
+        cache.delete(key)
+
+
+def invalidate(sender, instance, **kwargs):
+    """`post_save` / `post_delete` receiver: drops the row from this process now, and from both tiers after commit."""
+
+    pk = instance.pk
+    _local.delete(_key(sender, pk))
+    transaction.on_commit(lambda: _drop(sender, pk))
+
+
+def connect(model):
+    """Wires a model's signals to `invalidate` (once per model)."""
+
+    uid = "pkcache:{}".format(_label(model))
+    post_save.connect(invalidate, sender=model, weak=False, dispatch_uid=uid)
+    post_delete.connect(invalidate, sender=model, weak=False, dispatch_uid=uid)
+
+
+class PkCacheMixin(object):
+    """
+    Manager mixin serving primary-key `get()` and `in_bulk()` from the cache.
+
+    Only lookups by the primary key alone (`get(pk=...)`, `get(id=...)`,
+    `in_bulk([...])`) are cached; anything else -- including chains like
+    `objects.select_related(...).get(id=...)` -- goes to the database as usual.
+    """
+
+    def contribute_to_class(self, model, name):
+        super(PkCacheMixin, self).contribute_to_class(model, name)
+        if not model._meta.abstract:
+            connect(model)
+
+    def _normalize_pk(self, value):
+        """Returns the lookup value as the primary key's Python type, or None if it isn't a valid key."""
+
+        try:
+            return self.model._meta.pk.to_python(value)
+        except (ValidationError, TypeError):
+            return None
+
+    def _load(self, pks):
+        return self.get_queryset().in_bulk(pks)
+
+    def get(self, *args, **kwargs):
+        lookups = set(kwargs) - set(["pk", self.model._meta.pk.attname])
+        if args or lookups or len(kwargs) != 1:
+            return super(PkCacheMixin, self).get(*args, **kwargs)
+        pk = self._normalize_pk(list(kwargs.values())[0])
+        if pk is None:
+            return super(PkCacheMixin, self).get(*args, **kwargs)
+        found = lookup(self.model, [pk], self._load)
+        if pk not in found:
+            raise self.model.DoesNotExist("{} matching query does not exist.".format(self.model._meta.object_name))
+        return found[pk]
+
+    def in_bulk(self, id_list=None, field_name="pk"):
+        if id_list is None or field_name not in ("pk", self.model._meta.pk.attname):
+            return super(PkCacheMixin, self).in_bulk(id_list, field_name=field_name)
+        pks = [self._normalize_pk(value) for value in id_list]
+        if None in pks:
+            return super(PkCacheMixin, self).in_bulk(id_list, field_name=field_name)
+        return lookup(self.model, set(pks), self._load)
@@ -0,0 +1,141 @@
+"""
+On-demand request profiling (see `middleware.ProfilingMiddleware`).
+
+A profiled request runs either under cProfile (exact call counts, higher
+overhead) or under `StackSampler`, a background thread that snapshots the
+request thread's stack every few milliseconds (low overhead, collapsed-stack
+output for flame graphs). Dumps go to `settings.PROFILING_DIR`, named after the
+time, view and URL, and only the newest `PROFILING_MAX_FILES` are kept. The
+`profile_report` management command aggregates them.
+"""
+
+import itertools
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+MODES = ("cprofile", "sampler")
+SLUG_RE = re.compile(r"[^A-Za-z0-9]+")
+
+
+class StackSampler(object):
+    """
+    Samples one thread's Python stack at a fixed interval.
+
+    Parameters:
+    - `thread_ident` - `threading.current_thread().ident` of the thread to watch.
+    - `interval` - Seconds between samples.
+    """
+
+    def __init__(self, thread_ident, interval):
+        self.thread_ident = thread_ident
+        self.interval = interval
+        self.stacks = Counter() # "outer;...;inner" -> number of samples
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{}:{}".format(code.co_filename.replace(" ", "_"), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        """Writes collapsed stacks ("frame;frame;frame count" per line, as flamegraph.pl reads them)."""
+
+        with open(path, "w") as dump:
+            for stack, count in self.stacks.most_common():
+                dump.write("{} {}\n".format(stack, count))
+
+
+def profiling_dir():
+    directory = settings.PROFILING_DIR
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass # Another worker created it first
+    return directory
+
+
+_dump_numbers = itertools.count(1) # `next()` on it is atomic under the GIL
+
+
+def dump_path(view, url, extension):
+    """
+    Builds a dump file name tagged with time (to the millisecond), process,
+    a per-process sequence number -- so two dumps in the same millisecond never
+    share a name -- view and URL.
+    """
+
+    now = time.time()
+    slug = SLUG_RE.sub("-", url).strip("-")[:60] or "root"
+    stamp = "{}.{:03d}".format(time.strftime("%Y%m%d-%H%M%S", time.localtime(now)), int(now * 1000) % 1000)
+    name = "{}-{}-{}-{}-{}.{}".format(stamp, os.getpid(), next(_dump_numbers), view, slug, extension)
+    return os.path.join(profiling_dir(), name)
+
+
+def rotate(keep=None):
+    """Deletes all but the newest `keep` dump files (default `settings.PROFILING_MAX_FILES`)."""
+
+    keep = settings.PROFILING_MAX_FILES if keep is None else keep
+    directory = profiling_dir()
+    dumps = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith((".prof", ".collapsed"))]
+    dumps.sort(key=lambda path: os.path.getmtime(path), reverse=True)
+    for path in dumps[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass # Already rotated away by another worker
+
+
+def dumps(view=None):
+    """Returns `(prof_paths, collapsed_paths)` in the dump directory, optionally only for one view."""
+
+    directory = profiling_dir()
+    names = sorted(os.listdir(directory))
+    if view:
+        names = [name for name in names if "-{}-".format(view) in name]
+    prof = [os.path.join(directory, name) for name in names if name.endswith(".prof")]
+    collapsed = [os.path.join(directory, name) for name in names if name.endswith(".collapsed")]
+    return prof, collapsed
+
+
+def read_collapsed(paths):
+    """
+    Aggregates collapsed-stack files.
+
+    Returns `(own, total)` Counters of samples per frame: `own` counts samples
+    where the frame was running, `total` where it was anywhere on the stack.
+    """
+
+    own, total = Counter(), Counter()
+    for path in paths:
+        with open(path) as dump:
+            for line in dump:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                if not stack:
+                    continue
+                frames = stack.split(";")
+                own[frames[-1]] += int(count)
+                for frame in set(frames):
+                    total[frame] += int(count)
+    return own, total
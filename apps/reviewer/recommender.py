@@ -0,0 +1,209 @@
+"""
+Offline item-to-item recommendation engine ("readers who liked this also liked").
+
+Streams `(user_id, book_id, rating)` out of every review (hot and archived) into NumPy arrays, builds a
+sparse user x book matrix with SciPy and stores the top-K neighbors of each book
+in the `BookNeighbor` table. `views.book` then only has to read those rows back.
+
+The default "cosine" metric is the adjusted cosine: each reader's ratings are
+centered on that reader's own mean first. Two books the same readers rated 1
+and 5 then come out dissimilar (on raw ratings they looked alike just for
+sharing readers), and a generous reader's 4 counts for no more than a harsh
+reader's 3. Only positively similar books are stored as neighbors.
+
+Run from the `build_recommendations` management command.
+"""
+
+from __future__ import division
+
+import numpy as np
+from scipy import sparse
+from django.db import transaction
+from django.utils import timezone
+
+from models import Review, BookNeighbor, RecommendationRun # gives us access to models
+from archive import iter_all_reviews # reads both review partitions
+
+TOP_K = 10 # Neighbors stored per book
+CHUNK_SIZE = 10000 # Rows pulled from the database per chunk while streaming
+BLOCK_SIZE = 1000 # Books scored per sparse product (bounds memory of the similarity block)
+SQL_BATCH_SIZE = 500 # Keeps `IN (...)` lists and bulk inserts under SQLite's variable limit
+METRICS = ("cosine", "co-rating")
+
+
+def load_ratings(chunk_size=CHUNK_SIZE):
+    """
+    Streams every review into three parallel NumPy arrays.
+
+    Parameters:
+    - `chunk_size` - Number of rows copied into NumPy at a time.
+
+    Returns `(user_ids, book_ids, ratings)`.
+    """
+
+    chunks = []
+    buf = np.empty((chunk_size, 3), dtype=np.int64)
+    filled = 0
+    rows = iter_all_reviews("user_id", "book_id", "rating")
+    for row in rows:
+        buf[filled] = row
+        filled += 1
+        if filled == chunk_size:
+            chunks.append(buf.copy())
+            filled = 0
+    chunks.append(buf[:filled].copy())
+    data = np.concatenate(chunks)
+    return data[:, 0], data[:, 1], data[:, 2]
+
+
+def build_matrix(user_ids, book_ids, ratings, metric="cosine"):
+    """
+    Builds the sparse user x book matrix.
+
+    Parameters:
+    - `user_ids`, `book_ids`, `ratings` - Parallel arrays from `load_ratings()`.
+    - `metric` - "cosine" keeps each rating minus the reader's mean rating
+    (adjusted cosine), "co-rating" keeps only a 1 per review.
+
+    Returns `(matrix, book_index)` where `book_index[column]` is the `Book` id of a column.
+    """
+
+    user_index, user_cols = np.unique(user_ids, return_inverse=True)
+    book_index, book_cols = np.unique(book_ids, return_inverse=True)
+    shape = (len(user_index), len(book_index))
+    counts = sparse.csr_matrix((np.ones(len(ratings), dtype=np.float32), (user_cols, book_cols)), shape=shape)
+    # A reader who reviewed the same book twice is still one reader:
+    if metric == "co-rating":
+        counts.data[:] = 1
+        return counts, book_index
+    matrix = sparse.csr_matrix((ratings.astype(np.float32), (user_cols, book_cols)), shape=shape)
+    matrix.data /= counts.data # their mean rating of it (both matrices have the same sorted structure)
+    # Center each reader's ratings on their mean:
+    reviewed = np.diff(matrix.indptr)
+    means = np.asarray(matrix.sum(axis=1)).ravel() / np.maximum(reviewed, 1)
+    matrix.data -= np.repeat(means, reviewed).astype(np.float32)
+    return matrix, book_index
+
+
+def normalize_columns(matrix):
+    """Scales every book column to unit length so a dot product becomes a cosine."""
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    norms[norms == 0] = 1
+    return matrix.dot(sparse.diags(1 / norms)).tocsc()
+
+
+def affected_columns(matrix, touched_cols):
+    """
+    Finds every book column whose neighbor list can change when `touched_cols` change.
+
+    A book's similarity to a touched book only moves if the two share a reader, so
+    the affected set is the touched books plus everything their readers reviewed
+    (with "cosine", a new review also moves its reader's mean, and so every
+    other rating of theirs). `matrix` must be the "co-rating" one: adjusted
+    ratings equal to the reader's mean are 0 and don't show who read what.
+    """
+
+    readers = np.unique(matrix[:, touched_cols].nonzero()[0])
+    co_rated = np.unique(matrix.tocsr()[readers].nonzero()[1])
+    return np.union1d(co_rated, touched_cols)
+
+
+def top_neighbors(matrix, cols, top_k=TOP_K):
+    """
+    Scores `cols` against every book and keeps the `top_k` best neighbors of each.
+
+    Parameters:
+    - `matrix` - CSC user x book matrix (normalized for cosine).
+    - `cols` - Column indices to score.
+    - `top_k` - Neighbors kept per book.
+
+    Yields `(col, neighbor_cols, scores)` with neighbors sorted best first.
+    """
+
+    for start in range(0, len(cols), BLOCK_SIZE):
+        block = cols[start:start + BLOCK_SIZE]
+        scores = matrix[:, block].T.dot(matrix).tocsr()
+        for i, col in enumerate(block):
+            row = scores.getrow(i)
+            keep = (row.indices != col) & (row.data > 0) # a book is not its own neighbor, nor one its readers disagree on
+            neighbor_cols, values = row.indices[keep], row.data[keep]
+            if len(values) > top_k:
+                best = np.argpartition(-values, top_k)[:top_k]
+                neighbor_cols, values = neighbor_cols[best], values[best]
+            order = np.lexsort((neighbor_cols, -values)) # best score first, ties by column
+            yield col, neighbor_cols[order], values[order]
+
+
+def last_run():
+    """Returns the most recent completed `RecommendationRun`, or None."""
+
+    return RecommendationRun.objects.filter(finished_at__isnull=False).order_by("-started_at").first()
+
+
+def touched_book_ids(since):
+    """Returns ids of books with a review created or edited at or after `since`."""
+
+    return set(Review.objects.filter(updated_at__gte=since).values_list("book_id", flat=True).distinct())
+
+
+def _chunks(items, size=SQL_BATCH_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def refresh(full=False, top_k=TOP_K, metric="cosine"):
+    """
+    Recomputes stored neighbors.
+
+    Parameters:
+    - `full` - Recompute every book. Otherwise only books touched since the last
+    completed run (and the books that share readers with them) are rewritten.
+    Falls back to a full run when there is no previous run.
+    - `top_k` - Neighbors stored per book.
+    - `metric` - "cosine" or "co-rating".
+
+    Note: Deleting a review does not leave a timestamp behind, so books that only
+    lost reviews keep their old neighbors until the next full run.
+
+    Returns the completed `RecommendationRun`.
+    """
+
+    previous = None if full else last_run()
+    run = RecommendationRun.objects.create(full=previous is None)
+
+    user_ids, book_ids, ratings = load_ratings()
+    matrix, book_index = build_matrix(user_ids, book_ids, ratings, metric=metric)
+    if metric == "cosine":
+        matrix = normalize_columns(matrix)
+    else:
+        matrix = matrix.tocsc()
+
+    if run.full:
+        target_cols = np.arange(len(book_index))
+        stale_ids = set(BookNeighbor.objects.values_list("book_id", flat=True).distinct()) - set(book_index.tolist())
+    else:
+        touched = touched_book_ids(previous.started_at)
+        touched_cols = np.flatnonzero(np.in1d(book_index, list(touched)))
+        readers = build_matrix(user_ids, book_ids, ratings, metric="co-rating")[0] if metric == "cosine" else matrix
+        target_cols = affected_columns(readers, touched_cols) if len(touched_cols) else touched_cols
+        # Touched books with no reviews left have nothing to recommend:
+        stale_ids = touched - set(book_index.tolist())
+
+    target_ids = [int(book_index[col]) for col in target_cols]
+    rows = []
+    for col, neighbor_cols, scores in top_neighbors(matrix, target_cols, top_k=top_k):
+        for rank, (neighbor_col, score) in enumerate(zip(neighbor_cols, scores)):
+            rows.append(BookNeighbor(book_id=int(book_index[col]), neighbor_id=int(book_index[neighbor_col]), score=float(score), rank=rank))
+
+    # Swap the old rows for the new ones atomically so readers never see a half-written list:
+    with transaction.atomic():
+        for ids in _chunks(set(target_ids) | stale_ids):
+            BookNeighbor.objects.filter(book_id__in=ids).delete()
+        BookNeighbor.objects.bulk_create(rows, batch_size=SQL_BATCH_SIZE)
+        run.books_refreshed = len(target_ids)
+        run.finished_at = timezone.now()
+        run.save()
+
+    return run
@@ -0,0 +1,153 @@
+"""
+Rating distribution reports over the whole review history (hot and archived).
+
+Streams `(author_id, reviewer signup date, rating, created_at)` out of every
+review in chunks of `CHUNK_SIZE` rows, turns each chunk into NumPy arrays and
+adds it to one rating histogram per group: `np.unique()` numbers the chunk's
+groups, and a single `np.bincount()` per grouping counts their ratings:
+
+- "author" -- the book's author,
+- "month" -- the month the review was written (UTC),
+- "cohort" -- the month the reviewer signed up (UTC).
+
+Ratings are whole numbers from 1 to `MAX_RATING`, so the histograms are
+exact: means and percentiles (nearest rank) come straight from the counts,
+and memory depends on the chunk size and the number of distinct groups, never
+on the number of reviews or how sparse the ids are. Reviews with a rating out
+of range are counted and left out.
+
+Run from the `review_report` management command.
+"""
+
+from __future__ import division
+
+from itertools import islice
+
+import numpy as np
+
+from models import Author # gives us access to models
+from archive import iter_all_reviews # reads both review partitions
+
+CHUNK_SIZE = 10000 # Rows pulled from the database per chunk while streaming
+SQL_BATCH_SIZE = 500 # Keeps `IN (...)` lists under SQLite's variable limit
+MAX_RATING = 5
+PERCENTILES = (25, 50, 75, 90)
+GROUPINGS = ("author", "month", "cohort")
+
+
+class Histograms(object):
+    """Rating counts per group key, for the keys seen so far (kept sorted)."""
+
+    def __init__(self):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros((0, MAX_RATING + 1), dtype=np.int64) # column r counts rating r
+
+    def add(self, keys, ratings):
+        if not len(keys):
+            return
+        width = MAX_RATING + 1
+        unique, inverse = np.unique(keys, return_inverse=True)
+        chunk = np.bincount(inverse * width + ratings, minlength=len(unique) * width).reshape(len(unique), width)
+        merged = np.union1d(self.keys, unique)
+        if len(merged) != len(self.keys):
+            counts = np.zeros((len(merged), width), dtype=np.int64)
+            counts[np.searchsorted(merged, self.keys)] = self.counts
+            self.keys, self.counts = merged, counts
+        self.counts[np.searchsorted(self.keys, unique)] += chunk
+
+
+def _months(datetimes):
+    """Months since January 1970 (UTC) of aware datetimes, as an int64 array."""
+
+    stamps = np.array([value.replace(tzinfo=None) for value in datetimes], dtype="datetime64[s]") # stored in UTC
+    return stamps.astype("datetime64[M]").astype(np.int64)
+
+
+def _month_label(month):
+    return str(np.datetime64(int(month), "M"))
+
+
+def collect(groupings=GROUPINGS, chunk_size=CHUNK_SIZE):
+    """
+    Streams every review into one `Histograms` per grouping.
+
+    Parameters:
+    - `groupings` - Any of `GROUPINGS`.
+    - `chunk_size` - Number of rows copied into NumPy at a time.
+
+    Returns `({grouping: Histograms}, invalid)`, where `invalid` counts reviews
+    left out for a rating outside 1 to `MAX_RATING`.
+    """
+
+    histograms = dict((grouping, Histograms()) for grouping in groupings)
+    invalid = 0
+    rows = iter_all_reviews("book__author_id", "user__created_at", "rating", "created_at")
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return histograms, invalid
+        author_ids, signed_up, ratings, created = zip(*chunk)
+        ratings = np.array(ratings, dtype=np.int64)
+        valid = (ratings >= 1) & (ratings <= MAX_RATING)
+        invalid += int(len(ratings) - valid.sum())
+        ratings = ratings[valid]
+        if "author" in histograms:
+            histograms["author"].add(np.array(author_ids, dtype=np.int64)[valid], ratings)
+        if "month" in histograms:
+            histograms["month"].add(_months(created)[valid], ratings)
+        if "cohort" in histograms:
+            histograms["cohort"].add(_months(signed_up)[valid], ratings)
+
+
+def _author_names(author_ids):
+    names = {}
+    for start in range(0, len(author_ids), SQL_BATCH_SIZE):
+        for author_id, first_name, last_name in Author.objects.filter(id__in=author_ids[start:start + SQL_BATCH_SIZE]).values_list("id", "first_name", "last_name"):
+            names[author_id] = "{} {}".format(first_name, last_name)
+    return names
+
+
+def summarize(grouping, histograms):
+    """
+    Turns one grouping's histograms into report rows, one per group with reviews.
+
+    Each row has `group`, `key`, `label`, `reviews`, `mean`, `p25`..`p90`
+    (see `PERCENTILES`) and `rating_1`..`rating_5` counts.
+    """
+
+    keys, counts = histograms.keys, histograms.counts
+    totals = counts.sum(axis=1)
+    means = counts.dot(np.arange(MAX_RATING + 1)) / totals
+    cumulative = counts.cumsum(axis=1)
+    percentiles = {}
+    for percentile in PERCENTILES:
+        ranks = np.ceil(totals * percentile / 100.0)
+        percentiles[percentile] = np.argmax(cumulative >= ranks[:, None], axis=1)
+
+    if grouping == "author":
+        names = _author_names([int(key) for key in keys])
+        labels = [names.get(int(key), "") for key in keys]
+    else:
+        labels = [_month_label(key) for key in keys]
+
+    rows = []
+    for index, key in enumerate(keys):
+        row = {
+            "group": grouping,
+            "key": int(key),
+            "label": labels[index],
+            "reviews": int(totals[index]),
+            "mean": round(float(means[index]), 3),
+        }
+        for percentile in PERCENTILES:
+            row["p{}".format(percentile)] = int(percentiles[percentile][index])
+        for rating in range(1, MAX_RATING + 1):
+            row["rating_{}".format(rating)] = int(counts[index, rating])
+        rows.append(row)
+    return rows
+
+
+def columns():
+    """Report row fields, in CSV column order."""
+
+    return ["group", "key", "label", "reviews", "mean"] + ["p{}".format(percentile) for percentile in PERCENTILES] + ["rating_{}".format(rating) for rating in range(1, MAX_RATING + 1)]
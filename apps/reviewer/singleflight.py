@@ -0,0 +1,173 @@
+"""
+Single-flight caching for expensive, shared page data (see `helper.book_page_data()`
+and `helper.dashboard_lists()`).
+
+`fetch()` keeps each value in the shared Django cache with a soft expiry
+(`ttl`) and a hard one (`ttl + stale_ttl`). When the soft expiry passes, one
+caller recomputes while everyone else keeps getting the old value:
+
+1. Inside a process, the first caller for a key becomes its leader; other
+threads serve the stale value, or -- on a cold miss -- wait up to
+`WAIT_TIMEOUT` seconds for the leader to finish.
+2. Across processes, the leader must also win a lease (`cache.add()`, held for
+at most `LEASE_TTL` seconds). A loser serves the stale value, or polls the
+cache for the winner's result.
+
+When the shared cache is the database cache (see `settings.CACHES`), a
+lease and a stored value would each be a write transaction on every miss, so
+values stay in each process's memory (`LOCAL_SIZE` of them) and only step 1
+applies; the generations still go through the shared cache.
+
+Stampedes are avoided before they start with probabilistic early refresh
+("XFetch"): a reader recomputes early with a probability that grows as the
+soft expiry nears and with how long the last computation took, so a hot key is
+usually refreshed by one reader before it ever goes stale.
+
+Outcomes are counted per cache and outcome in `reviewer_singleflight_total` on
+`/metrics`: "fresh" and "stale" hits, "early" refreshes, "waited" (served another
+caller's result) and "computed" (misses and expired values).
+
+Values must be picklable; evaluate querysets into lists first. Writes that
+change a cached value call `bump()` on the value's namespace, whose generation
+callers put in their keys.
+"""
+
+import math
+import random
+import threading
+import time
+import uuid
+
+from django.core.cache import cache
+
+from . import metrics # outcome counters
+from .pkcache import LocalLRU, read_generation, shared_tier
+
+STALE_TTL = 60 # Seconds a value past its `ttl` may still be served while one caller recomputes it
+LEASE_TTL = 10 # Seconds a process may hold a key's recompute lease (longer computations risk a second leader)
+WAIT_TIMEOUT = 2.0 # Seconds a caller waits for another's result on a cold miss before computing it itself
+POLL_INTERVAL = 0.05 # Seconds between cache polls while another process computes
+BETA = 1.0 # Early refresh eagerness (XFetch); above 1 refreshes earlier, 0 disables early refresh
+LOCAL_SIZE = 1000 # Values each process keeps when the shared cache is the database
+
+_flights = {} # key -> `threading.Event` set when this process's leader finishes
+_flights_lock = threading.Lock()
+_local = LocalLRU(size=LOCAL_SIZE)
+
+
+def _count(name, outcome):
+    metrics.increment("reviewer_singleflight_total", (name, outcome))
+
+
+def generation(namespace):
+    """Returns the namespace's current generation; put it in the keys of values `bump()` should drop."""
+
+    return read_generation("singleflight:gen:{}".format(namespace))
+
+
+def bump(namespace):
+    """Abandons every cached value keyed with the namespace's generation."""
+
+    cache.set("singleflight:gen:{}".format(namespace), uuid.uuid4().hex, None) # a new value every time, even if two bumps race
+
+
+def _get(key):
+    return cache.get(key) if shared_tier() else _local.get(key)
+
+
+def _store(key, compute, ttl, stale_ttl):
+    started = time.time()
+    value = compute()
+    finished = time.time()
+    entry = (value, finished - started, finished + ttl)
+    if shared_tier():
+        cache.set(key, entry, ttl + stale_ttl)
+    else:
+        _local.set(key, entry, ttl + stale_ttl)
+    return value
+
+
+def _lease(key):
+    """Returns the key's lease name if this process won it, else None (another process holds it)."""
+
+    lease = "{}:lease".format(key)
+    if not shared_tier() or cache.add(lease, True, LEASE_TTL):
+        return lease
+    if cache.get(lease) is None:
+        return lease # just released, or the cache is unreachable: don't wait on nobody
+    return None
+
+
+def _poll(key, deadline):
+    while time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+    return None
+
+
+def fetch(name, key, compute, ttl, stale_ttl=STALE_TTL, beta=BETA):
+    """
+    Returns the cached value for `key`, recomputing it at most once at a time.
+
+    Parameters:
+    - `name` - Cache name, for the metrics (e.g. "book_page"; must be listed in `metrics.COUNTERS`).
+    - `key` - Key within that cache.
+    - `compute` - Function taking no arguments and returning the value.
+    - `ttl` - Seconds the value counts as fresh.
+    - `stale_ttl` - Seconds after that it may still be served while being recomputed.
+    - `beta` - Early refresh eagerness.
+    """
+
+    key = "singleflight:{}:{}".format(name, key)
+    entry = _get(key) # (value, seconds the computation took, soft expiry)
+    if entry is not None:
+        value, delta, expires = entry
+        # XFetch: `-log(u)` is usually small, occasionally large -- the closer to `expires`, the likelier a refresh:
+        if time.time() - delta * beta * math.log(1.0 - random.random()) < expires:
+            _count(name, "fresh")
+            return value
+
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = threading.Event()
+
+    if not leader:
+        # Another thread here is already on it:
+        if entry is not None:
+            _count(name, "stale")
+            return entry[0]
+        flight.wait(WAIT_TIMEOUT)
+        entry = _get(key)
+        if entry is not None:
+            _count(name, "waited")
+            return entry[0]
+        _count(name, "computed") # the leader failed or is too slow
+        return _store(key, compute, ttl, stale_ttl)
+
+    try:
+        lease = _lease(key)
+        if lease is not None:
+            try:
+                _count(name, "early" if entry is not None and time.time() < entry[2] else "computed")
+                return _store(key, compute, ttl, stale_ttl)
+            finally:
+                if shared_tier():
+                    cache.delete(lease)
+        # Another process is on it:
+        if entry is not None:
+            _count(name, "stale")
+            return entry[0]
+        entry = _poll(key, time.time() + WAIT_TIMEOUT)
+        if entry is not None:
+            _count(name, "waited")
+            return entry[0]
+        _count(name, "computed")
+        return _store(key, compute, ttl, stale_ttl)
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        flight.set()
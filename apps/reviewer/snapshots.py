@@ -0,0 +1,90 @@
+"""
+Pre-rendered, gzip-compressed snapshots of public book pages.
+
+Logged-out visitors and crawlers see the same book page, which only changes
+when one of the book's reviews is added or deleted. Each of those writes
+queues a `snapshot_book` job (one per book while waiting, see
+`ReviewManager._queue_snapshot()`), and the worker re-renders just that book
+into `settings.SNAPSHOT_DIR/books/<id>.html.gz`. `views.book` then serves the
+file as-is -- or hands it to the front server with `X-Accel-Redirect` when
+`settings.SNAPSHOT_ACCEL_PREFIX` is set -- without touching the database.
+
+`build_snapshots` rebuilds every book, e.g. on deploy (templates changed) or
+after `build_recommendations` (the "also liked" list is part of the page).
+"""
+
+import gzip
+import os
+import tempfile
+
+from django.conf import settings
+from django.template.loader import render_to_string
+
+from models import Book, BookNeighbor # gives us access to models
+from . import archive # hot/cold review partitions
+from . import helper # star ratings
+
+COMPRESS_LEVEL = 9 # Written once, served many times -- worth the best ratio
+
+
+def snapshot_path(book_id):
+    return os.path.join(settings.SNAPSHOT_DIR, "books", "{}.html.gz".format(int(book_id)))
+
+
+def accel_path(book_id):
+    """Internal URL of a snapshot for `X-Accel-Redirect` (see `settings.SNAPSHOT_ACCEL_PREFIX`)."""
+
+    return "{}books/{}.html.gz".format(settings.SNAPSHOT_ACCEL_PREFIX, int(book_id))
+
+
+def render_book(book):
+    """Renders the logged-out page of `book`: details, recommendations and the newest page of reviews."""
+
+    reviews, has_next = archive.reviews_page(1, book_id=book.id)
+    helper.make_stars(reviews)
+    return render_to_string("reviewer/public_book.html", {
+        "book": book,
+        "all_reviews": reviews,
+        "next_page": 2 if has_next else None,
+        "recommended_books": BookNeighbor.objects.filter(book__id=book.id).select_related("neighbor"),
+    })
+
+
+def write(book_id):
+    """
+    Regenerates the snapshot of one book (or removes it if the book is gone).
+
+    The file is written next to its final name and renamed into place, so
+    readers never see a half-written snapshot.
+    """
+
+    path = snapshot_path(book_id)
+    book = Book.objects.select_related("author").filter(id=book_id).first()
+    if book is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return False
+
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass # Another worker created it first
+    html = render_book(book).encode("utf-8")
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(handle, "wb") as raw:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=raw, compresslevel=COMPRESS_LEVEL, mtime=0) as compressed:
+            compressed.write(html)
+    os.chmod(temp_path, 0o644) # readable by the front server
+    os.rename(temp_path, path)
+    return True
+
+
+def build_all():
+    """Regenerates every book's snapshot; returns the number written."""
+
+    written = 0
+    for book_id in Book.objects.values_list("id", flat=True).order_by("id").iterator():
+        written += write(book_id)
+    return written
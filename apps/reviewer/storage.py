@@ -0,0 +1,149 @@
+"""
+Static file storage for production: hashed, minified and precompressed assets.
+
+`collectstatic` with `CompressedManifestStaticFilesStorage`:
+
+1. Trims font-awesome down to the icons our templates use and to the woff2/woff
+font formats every supported browser loads (the other formats are never collected,
+see `apps.StaticFilesConfig`).
+2. Minifies CSS.
+3. Fingerprints every file name with a content hash (`ManifestStaticFilesStorage`),
+so hashed files can be cached forever with `Cache-Control: immutable`.
+4. Writes `.gz` and `.br` next to each compressible hashed file so neither the
+app (`views.static_asset`) nor a front server has to compress per request.
+"""
+
+import gzip
+import io
+import os
+import re
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+try:
+    import brotli # optional: `pip install Brotli` for .br variants
+except ImportError:
+    brotli = None
+
+FONT_AWESOME_CSS = "reviewer/css/font-awesome-4.7.0/css/font-awesome.css"
+FONT_FORMATS = ("woff2", "woff") # Font formats kept in @font-face
+COMPRESSIBLE = (".css", ".js", ".svg", ".txt", ".html", ".json", ".xml", ".map")
+MIN_COMPRESS_SIZE = 256 # Bytes; smaller files are not worth an extra request header
+
+ICON_CLASS_RE = re.compile(r"\bfa-[a-z0-9-]+")
+ICON_RULE_RE = re.compile(r"((?:\.fa-[a-z0-9-]+:before\s*,?\s*)+)\{\s*content:[^}]*\}\s*")
+FONT_SRC_RE = re.compile(r"src:\s*([^;]+);")
+FONT_SOURCE_RE = re.compile(r"url\([^)]*\)\s*format\('([a-z0-9-]+)'\)")
+
+
+def used_icon_classes():
+    """Returns every `fa-*` class name that appears in a project template."""
+
+    template_dirs = list(settings.TEMPLATES[0].get("DIRS", []))
+    template_dirs += [os.path.join(app_config.path, "templates") for app_config in apps.get_app_configs()]
+    used = set()
+    for template_dir in template_dirs:
+        for root, dirs, files in os.walk(template_dir):
+            for filename in files:
+                if filename.endswith(".html"):
+                    with io.open(os.path.join(root, filename), encoding="utf-8") as template:
+                        used.update(ICON_CLASS_RE.findall(template.read()))
+    return used
+
+
+def subset_font_awesome(css, used):
+    """
+    Drops icon rules and font formats we never use from font-awesome's CSS.
+
+    Parameters:
+    - `css` - Contents of `font-awesome.css`.
+    - `used` - Set of `fa-*` class names used by templates.
+    """
+
+    def keep_icon(match):
+        selectors = [selector.strip() for selector in match.group(1).split(",") if selector.strip()]
+        selectors = [selector for selector in selectors if selector[1:-len(":before")] in used]
+        if not selectors:
+            return ""
+        return "{} {{{}}}\n".format(",".join(selectors), match.group(0)[match.group(0).index("{") + 1:match.group(0).rindex("}")])
+
+    def keep_formats(match):
+        sources = [source.group(0) for source in FONT_SOURCE_RE.finditer(match.group(1)) if source.group(1) in FONT_FORMATS]
+        return "src: {};".format(", ".join(sources)) if sources else ""
+
+    css = ICON_RULE_RE.sub(keep_icon, css)
+    return FONT_SRC_RE.sub(keep_formats, css)
+
+
+def minify_css(css):
+    """
+    Conservative CSS minifier: drops comments (except `/*! license */` ones) and
+    whitespace that cannot change meaning.
+    """
+
+    css = re.sub(r"/\*(?!!).*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css) # only after colons; a space before one is a descendant selector
+    css = css.replace(";}", "}")
+    return css.strip()
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    `ManifestStaticFilesStorage` that minifies CSS before hashing and writes
+    gzip/brotli variants of the hashed files afterwards.
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        if dry_run:
+            for result in super(CompressedManifestStaticFilesStorage, self).post_process(paths, dry_run, **options):
+                yield result
+            return
+
+        # Rewrite CSS in the collected copy first so the hash covers the final bytes:
+        used = used_icon_classes()
+        for path in paths:
+            if path.endswith(".css"):
+                storage, source = paths[path]
+                with storage.open(source) as original:
+                    css = original.read().decode("utf-8")
+                if path == FONT_AWESOME_CSS:
+                    css = subset_font_awesome(css, used)
+                self._replace(path, minify_css(css).encode("utf-8"))
+                paths[path] = (self, path)
+
+        hashed_names = set()
+        for name, hashed_name, processed in super(CompressedManifestStaticFilesStorage, self).post_process(paths, dry_run, **options):
+            if hashed_name and not isinstance(processed, Exception):
+                hashed_names.add(hashed_name)
+            yield name, hashed_name, processed
+
+        for hashed_name in sorted(hashed_names):
+            if hashed_name.endswith(COMPRESSIBLE):
+                self.compress(hashed_name)
+
+    def compress(self, name):
+        """Writes `name.gz` (and `name.br` if brotli is installed) when that saves space."""
+
+        with self.open(name) as original:
+            content = original.read()
+        if len(content) < MIN_COMPRESS_SIZE:
+            return
+        buf = io.BytesIO()
+        with gzip.GzipFile(filename="", mode="wb", fileobj=buf, compresslevel=9, mtime=0) as gz:
+            gz.write(content)
+        variants = [(".gz", buf.getvalue())]
+        if brotli is not None:
+            variants.append((".br", brotli.compress(content)))
+        for suffix, compressed in variants:
+            if len(compressed) < len(content):
+                self._replace(name + suffix, compressed)
+
+    def _replace(self, name, content):
+        if self.exists(name):
+            self.delete(name)
+        self._save(name, ContentFile(content))
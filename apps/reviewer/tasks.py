@@ -0,0 +1,48 @@
+"""
+Background job handlers, run by the `run_workers` management command.
+
+Every side effect of a write that does not have to happen before the response
+is sent lives here. Each handler receives a list of job payloads (see
+`jobs.handler`) and applies them as one batch.
+"""
+
+from django.utils.dateparse import parse_datetime
+
+from . import feed # followers' review feeds
+from . import jobs # job queue
+from . import leaderboard # trending and top rated books
+from . import snapshots # pre-rendered public book pages
+
+
+@jobs.handler("review_changed")
+def review_changed(payloads):
+    """
+    Updates data derived from reviews after reviews are written or deleted.
+
+    Payloads come from `ReviewManager._change_payload()`.
+    """
+
+    leaderboard.apply_reviews([(payload["book_id"], payload["rating"], parse_datetime(payload["created_at"]), payload["added"]) for payload in payloads])
+
+
+@jobs.handler("fan_out_review")
+def fan_out_review(payloads):
+    """Copies new reviews into followers' feeds (see `feed.py`)."""
+
+    feed.fan_out([payload["review_id"] for payload in payloads])
+
+
+@jobs.handler("backfill_feed")
+def backfill_feed(payloads):
+    """Fills new followers' feeds with the followed reviewers' recent reviews."""
+
+    for payload in payloads:
+        feed.backfill(payload["follower_id"], payload["followee_id"])
+
+
+@jobs.handler("snapshot_book")
+def snapshot_book(payloads):
+    """Re-renders the logged-out pages of books whose reviews changed (see `snapshots.py`)."""
+
+    for book_id in set(payload["book_id"] for payload in payloads):
+        snapshots.write(book_id)
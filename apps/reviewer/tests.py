@@ -1,3 +1,423 @@
-from django.test import TestCase
+import json
+import threading
+import time
+from datetime import timedelta
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from models import User, Author, AuthorStats, Book, BookScore, Review, ArchivedReview, Follow, FeedEntry, ApiToken, Job
+from . import admission
+from . import archive
+from . import feed
+from . import jobs
+from . import leaderboard
+from . import pkcache
+from . import reports
+from . import singleflight
+from . import tasks # registers the job handlers
+from . import views
+from .titles import normalize_title, merge_duplicate_books
+
+LOCAL_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}} # never the developer's shared cache
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class CachedTestCase(TestCase):
+    """Starts every test with empty caches, so rows cached by an earlier test (same ids, other data) never leak in."""
+
+    def setUp(self):
+        cache.clear()
+        pkcache._local.clear()
+        singleflight._local.clear()
+
+
+class RunBatchTests(TestCase):
+    """`jobs.run_batch()` must leave nothing applied when a batch fails, so retries don't double-count."""
+
+    def setUp(self):
+        author = Author.objects.create(first_name="Ray", last_name="Bradbury")
+        self.book_a = Book.objects.create(title="Fahrenheit 451", author=author)
+        self.book_b = Book.objects.create(title="The Martian Chronicles", author=author)
+        self.user = User.objects.create(first_name="Ann", last_name="Reader", email="ann@example.com", password="x")
+
+    def enqueue_review(self, book, rating, created_at):
+        return Job.objects.enqueue("review_changed", {"review_id": 1, "book_id": book.id, "user_id": self.user.id, "rating": rating, "created_at": created_at.isoformat(), "added": True})
+
+    def test_retried_batch_counts_each_review_once(self):
+        created_at = timezone.now()
+        batch = [self.enqueue_review(self.book_a, 5, created_at), self.enqueue_review(self.book_b, 3, created_at)]
+        handler = jobs.HANDLERS["review_changed"]
+        failures = []
+
+        def fail_once(payloads):
+            handler(payloads) # book A's (and B's) scores are written...
+            if not failures:
+                failures.append(True)
+                raise IOError("transient failure") # ...then the batch fails before its jobs are deleted
+        jobs.HANDLERS["review_changed"] = fail_once
+        try:
+            self.assertFalse(jobs.run_batch(batch))
+            self.assertTrue(jobs.run_batch(list(Job.objects.order_by("id"))))
+        finally:
+            jobs.HANDLERS["review_changed"] = handler
+
+        once = leaderboard.decay_exponent(created_at) # one review's weight; applied twice it would be log(2) higher
+        self.assertAlmostEqual(BookScore.objects.get(book_id=self.book_a.id).trending_score, once)
+        self.assertAlmostEqual(BookScore.objects.get(book_id=self.book_b.id).trending_score, once)
+        self.assertFalse(Job.objects.exists())
+
+
+class TitleTests(CachedTestCase):
+    """Duplicate-book detection: title keys, "did you mean" suggestions and merging."""
+
+    def setUp(self):
+        super(TitleTests, self).setUp()
+        self.author = Author.objects.create(first_name="Stephen", last_name="King")
+        self.user = User.objects.create(first_name="Ann", last_name="Reader", email="ann@example.com", password="x")
+
+    def test_title_variants_share_a_key(self):
+        self.assertEqual(normalize_title("The Shining"), "shining")
+        self.assertEqual(normalize_title("  the   SHINING!"), "shining")
+        self.assertEqual(normalize_title("Shining, The"), "shining")
+        self.assertEqual(normalize_title(u"Caf\u00e9 Stories"), "cafe stories")
+        self.assertEqual(normalize_title("The"), "the") # a lone article is the title
+
+    def test_suggest_finds_near_misses(self):
+        shining = Book.objects.create(title="The Shining", author=self.author)
+        Book.objects.create(title="Carrie", author=self.author)
+        self.assertEqual(Book.objects.suggest("The Shinning"), [shining])
+        self.assertEqual(Book.objects.suggest("Dune"), [])
+
+    def test_find_existing_matches_by_key_for_the_same_author_only(self):
+        shining = Book.objects.create(title="The Shining", author=self.author)
+        other = Author.objects.create(first_name="Someone", last_name="Else")
+        self.assertEqual(Book.objects.find_existing("Shining, The", self.author), shining)
+        self.assertIsNone(Book.objects.find_existing("Shining, The", other))
+
+    def test_merge_folds_duplicates_into_the_oldest_book(self):
+        kept = Book.objects.create(title="The Shining", author=self.author)
+        duplicate = Book.objects.create(title="Carrie", author=self.author)
+        # As migration 0005 leaves a duplicate that existed before title keys:
+        Book.objects.filter(id=duplicate.id).update(title="Shining, The", title_key="shining #{}".format(duplicate.id))
+        Review.objects.create(description="Great", rating=5, user=self.user, book=kept)
+        Review.objects.create(description="Scary", rating=3, user=self.user, book_id=duplicate.id)
+        BookScore.objects.create(book=kept, review_count=1, rating_sum=5)
+        BookScore.objects.create(book_id=duplicate.id, review_count=1, rating_sum=3)
+
+        self.assertEqual(merge_duplicate_books(Book, Review, BookScore, dry_run=True), [(kept.id, [duplicate.id])])
+        self.assertTrue(Book.objects.filter(id=duplicate.id).exists()) # a dry run changes nothing
+        self.assertEqual(merge_duplicate_books(Book, Review, BookScore), [(kept.id, [duplicate.id])])
+
+        self.assertFalse(Book.objects.filter(id=duplicate.id).exists())
+        self.assertEqual(Review.objects.filter(book=kept).count(), 2)
+        score = BookScore.objects.get(book=kept)
+        self.assertEqual((score.review_count, score.rating_sum), (2, 8))
+        self.assertEqual(merge_duplicate_books(Book, Review, BookScore), []) # nothing left to merge
+
+
+class ArchivePagingTests(CachedTestCase):
+    """`archive.reviews_page()` must page through hot then archived reviews as if they were one table."""
+
+    def setUp(self):
+        super(ArchivePagingTests, self).setUp()
+        author = Author.objects.create(first_name="Ray", last_name="Bradbury")
+        self.book = Book.objects.create(title="Fahrenheit 451", author=author)
+        user = User.objects.create(first_name="Ann", last_name="Reader", email="ann@example.com", password="x")
+        now = timezone.now()
+        for day in range(25):
+            review = Review.objects.create(description="Day {}".format(day), rating=3, user=user, book=self.book)
+            Review.objects.filter(id=review.id).update(created_at=now - timedelta(days=day))
+        self.newest_first = ["Day {}".format(day) for day in range(25)]
+        self.moved = archive.archive_reviews(now - timedelta(days=9, hours=12)) # days 10 to 24 go cold
+
+    def page(self, number, per_page=10):
+        reviews, has_next = archive.reviews_page(number, per_page=per_page, book_id=self.book.id)
+        return [review.description for review in reviews], has_next
+
+    def test_archive_moves_only_old_reviews(self):
+        self.assertEqual(self.moved, 15)
+        self.assertEqual(Review.objects.count(), 10)
+        self.assertEqual(ArchivedReview.objects.count(), 15)
+        self.assertEqual(archive.count_reviews(book_id=self.book.id), 25)
+        self.assertEqual(list(archive.reviewed_books()), [self.book])
+
+    def test_pages_continue_from_hot_into_cold(self):
+        self.assertEqual(self.page(1), (self.newest_first[:10], True)) # exactly the hot rows
+        self.assertEqual(self.page(2), (self.newest_first[10:20], True))
+        self.assertEqual(self.page(3), (self.newest_first[20:], False))
+        self.assertEqual(self.page(4), ([], False))
+
+    def test_a_page_can_straddle_both_tables(self):
+        self.assertEqual(self.page(2, per_page=7), (self.newest_first[7:14], True))
+        self.assertEqual(self.page(4, per_page=7), (self.newest_first[21:], False))
+
+    def test_all_reviews_are_streamed_once(self):
+        self.assertEqual(sorted(description for (description,) in archive.iter_all_reviews("description")), sorted(self.newest_first))
+
+
+class FeedTests(CachedTestCase):
+    """Fan-out, backfill and unfollow keep feeds to exactly the followed reviewers' reviews."""
+
+    def setUp(self):
+        super(FeedTests, self).setUp()
+        author = Author.objects.create(first_name="Ray", last_name="Bradbury")
+        self.book = Book.objects.create(title="Fahrenheit 451", author=author)
+        self.reader = User.objects.create(first_name="Ann", last_name="Reader", email="ann@example.com", password="x")
+        self.reviewer = User.objects.create(first_name="Bob", last_name="Critic", email="bob@example.com", password="x")
+
+    def review(self, description):
+        return Review.objects.create(description=description, rating=4, user=self.reviewer, book=self.book)
+
+    def feed(self):
+        return [review.description for review in feed.read(self.reader.id)]
+
+    def test_follow_backfills_and_fan_out_adds_new_reviews(self):
+        self.review("Old")
+        Follow.objects.follow(self.reader.id, self.reviewer.id)
+        self.assertEqual(feed.backfill(self.reader.id, self.reviewer.id), 1)
+        self.assertEqual(feed.backfill(self.reader.id, self.reviewer.id), 0) # a retried job adds nothing
+        new = self.review("New")
+        self.assertEqual(feed.fan_out([new.id]), 1)
+        self.assertEqual(feed.fan_out([new.id]), 0)
+        self.assertEqual(self.feed(), ["New", "Old"])
+
+    def test_unfollow_empties_the_feed_and_stops_later_jobs(self):
+        Follow.objects.follow(self.reader.id, self.reviewer.id)
+        new = self.review("New")
+        self.assertTrue(Follow.objects.unfollow(self.reader.id, self.reviewer.id))
+        # Jobs queued before the unfollow run after it:
+        self.assertEqual(feed.backfill(self.reader.id, self.reviewer.id), 0)
+        self.assertEqual(feed.fan_out([new.id]), 0)
+        self.assertEqual(self.feed(), [])
+        self.assertFalse(FeedEntry.objects.exists())
+
+    def test_feeds_are_trimmed(self):
+        Follow.objects.follow(self.reader.id, self.reviewer.id)
+        feed.fan_out([self.review("Review {}".format(i)).id for i in range(feed.FEED_SIZE + feed.TRIM_SLACK + 1)])
+        self.assertEqual(FeedEntry.objects.filter(owner=self.reader).count(), feed.FEED_SIZE)
+
+    def test_popular_reviewers_are_pulled_at_read_time(self):
+        Follow.objects.follow(self.reader.id, self.reviewer.id)
+        original = feed.PULL_FOLLOWERS
+        feed.PULL_FOLLOWERS = 1
+        try:
+            self.assertEqual(feed.fan_out([self.review("Pulled").id]), 0)
+        finally:
+            feed.PULL_FOLLOWERS = original
+        self.assertTrue(User.objects.filter(id=self.reviewer.id, feed_pull=True).exists())
+        self.assertEqual(self.feed(), ["Pulled"])
+
+
+class BatchApiTests(CachedTestCase):
+    """`/api/reviews/batch` creates the valid reviews and reports every invalid one in its place."""
+
+    def setUp(self):
+        super(BatchApiTests, self).setUp()
+        self.author = Author.objects.create(first_name="Ray", last_name="Bradbury")
+        self.book = Book.objects.create(title="Fahrenheit 451", author=self.author)
+        self.user = User.objects.create(first_name="Ann", last_name="Reader", email="ann@example.com", password="x")
+        self.token = ApiToken.objects.create(key=ApiToken.generate_key(), user=self.user, name="Partner")
+
+    def post(self, reviews, key=None):
+        body = json.dumps({"reviews": reviews})
+        return self.client.post("/api/reviews/batch", body, content_type="application/json", HTTP_AUTHORIZATION="Token {}".format(key or self.token.key))
+
+    def test_valid_reviews_are_created_next_to_per_item_errors(self):
+        response = self.post([
+            {"description": "Great", "rating": 5, "book_id": self.book.id},
+            {"description": "", "rating": 5, "book_id": self.book.id},
+            {"description": "Hmm", "rating": True, "book_id": self.book.id},
+            {"description": "Hmm", "rating": 4.9, "book_id": self.book.id},
+            {"description": ["not", "text"], "rating": 3, "book_id": self.book.id},
+            {"description": "Lost", "rating": 3, "book_id": 999999},
+            {"description": "New", "rating": 4, "book": "Dandelion Wine", "author": "Ray Bradbury"},
+            "not an object",
+        ])
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual((data["created"], data["failed"]), (2, 6))
+        results = data["results"]
+        self.assertEqual(results[0]["book_id"], self.book.id)
+        self.assertEqual(results[1]["errors"], ["A review is required."])
+        self.assertEqual(results[2]["errors"], ["Rating must be a whole number from 1 to 5."])
+        self.assertEqual(results[3]["errors"], ["Rating must be a whole number from 1 to 5."])
+        self.assertEqual(results[4]["errors"], ["Review must be text."])
+        self.assertEqual(results[5]["errors"], ["Book not found."])
+        self.assertEqual(Book.objects.get(id=results[6]["book_id"]).author_id, self.author.id)
+        self.assertEqual(results[7]["errors"], ["Each review must be a JSON object."])
+        self.assertEqual(Review.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(AuthorStats.objects.get(author=self.author).review_count, 2)
+
+    def test_authors_sharing_a_name_keep_their_own_books(self):
+        namesake = Author.objects.create(first_name="Ray", last_name="Bradbury")
+        theirs = Book.objects.create(title="Fahrenheit 451", author=namesake)
+        response = self.post([{"description": "Mine", "rating": 4, "book": "Fahrenheit 451", "author_id": namesake.id}])
+        self.assertEqual(json.loads(response.content)["results"], [{"review_id": Review.objects.get().id, "book_id": theirs.id}])
+
+    def test_limits_and_authentication(self):
+        item = {"description": "Great", "rating": 5, "book_id": self.book.id}
+        self.assertEqual(self.post([item] * views.API_BATCH_LIMIT).status_code, 200)
+        self.assertEqual(self.post([item] * (views.API_BATCH_LIMIT + 1)).status_code, 400)
+        self.assertEqual(self.post([]).status_code, 400)
+        self.assertEqual(self.post([item], key="wrong").status_code, 401)
+        self.assertEqual(Review.objects.count(), views.API_BATCH_LIMIT)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class PkCacheTests(TransactionTestCase):
+    """Cached primary-key lookups must never outlive a committed write (invalidations run on commit, hence no `TestCase`)."""
+
+    def setUp(self):
+        cache.clear()
+        pkcache._local.clear()
+        self.author = Author.objects.create(first_name="Ray", last_name="Bradbury")
+
+    def test_repeated_lookups_skip_the_database(self):
+        Author.objects.get(id=self.author.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(Author.objects.get(id=self.author.id).last_name, "Bradbury")
+        pkcache._local.clear() # another process: only the shared tier has the row
+        with self.assertNumQueries(0):
+            self.assertEqual(Author.objects.in_bulk([self.author.id])[self.author.id].last_name, "Bradbury")
+
+    def test_save_and_delete_invalidate(self):
+        author = Author.objects.get(id=self.author.id)
+        author.last_name = "Douglas"
+        author.save()
+        self.assertEqual(Author.objects.get(id=self.author.id).last_name, "Douglas")
+        author.delete()
+        with self.assertRaises(Author.DoesNotExist):
+            Author.objects.get(id=self.author.id)
+
+    def test_bump_abandons_rows_changed_by_update(self):
+        Author.objects.get(id=self.author.id)
+        before = pkcache.generation(Author)
+        Author.objects.filter(id=self.author.id).update(last_name="Douglas")
+        pkcache.bump(Author)
+        self.assertNotEqual(pkcache.generation(Author), before)
+        self.assertEqual(Author.objects.get(id=self.author.id).last_name, "Douglas")
+
+    def test_evicted_generation_does_not_bring_back_old_rows(self):
+        Author.objects.get(id=self.author.id)
+        before = pkcache.generation(Author)
+        Author.objects.filter(id=self.author.id).update(last_name="Douglas") # no bump: the cached row is stale...
+        cache.delete("pkcache:gen:reviewer.author") # ...until its generation is evicted
+        pkcache._local.clear()
+        self.assertNotEqual(pkcache.generation(Author), before)
+        self.assertEqual(Author.objects.get(id=self.author.id).last_name, "Douglas")
+
+    def test_database_cache_holds_no_rows(self):
+        self.assertTrue(pkcache.shared_tier())
+        with self.settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.db.DatabaseCache", "LOCATION": "unused_cache_table"}}):
+            self.assertFalse(pkcache.shared_tier())
+
+
+class GateTests(SimpleTestCase):
+    """`admission.Gate` admits up to its limits, sheds what can't start in time, and lets waiting reads go first."""
+
+    def enter_later(self, gate, route, deadline):
+        """Calls `gate.enter()` in a thread; returns the thread and a list that receives the result."""
+
+        result = []
+        thread = threading.Thread(target=lambda: result.append(gate.enter(route, deadline)))
+        thread.start()
+        return thread, result
+
+    def wait_until_waiting(self, gate, route):
+        for attempt in range(200):
+            if gate.waiting[route]:
+                return
+            time.sleep(0.005)
+        self.fail("no {} request started waiting".format(route))
+
+    def test_late_requests_are_shed_even_with_room(self):
+        gate = admission.Gate(4, {"read": 4}, 4)
+        self.assertEqual(gate.enter("read", time.time() - 1), "deadline")
+        self.assertEqual(gate.in_flight["read"], 0)
+
+    def test_full_queue_sheds_at_once(self):
+        gate = admission.Gate(4, {"auth": 1}, 0)
+        self.assertIsNone(gate.enter("auth", time.time() + 10))
+        start = time.time()
+        self.assertEqual(gate.enter("auth", time.time() + 10), "queue_full")
+        self.assertLess(time.time() - start, 1)
+
+    def test_waiting_request_is_shed_at_its_deadline(self):
+        gate = admission.Gate(1, {}, 4)
+        self.assertIsNone(gate.enter("write", time.time() + 10))
+        self.assertEqual(gate.enter("write", time.time() + 0.05), "deadline")
+        self.assertEqual(gate.waiting["write"], 0)
+
+    def test_leave_admits_a_waiting_request(self):
+        gate = admission.Gate(1, {}, 4)
+        self.assertIsNone(gate.enter("write", time.time() + 10))
+        thread, result = self.enter_later(gate, "write", time.time() + 10)
+        self.wait_until_waiting(gate, "write")
+        gate.leave("write")
+        thread.join(5)
+        self.assertEqual(result, [None])
+        self.assertEqual(gate.in_flight["write"], 1)
+
+    def test_waiting_reads_hold_a_slot_back_from_writes(self):
+        gate = admission.Gate(2, {"read": 1}, 4)
+        self.assertIsNone(gate.enter("read", time.time() + 10))
+        thread, result = self.enter_later(gate, "read", time.time() + 10)
+        self.wait_until_waiting(gate, "read")
+        self.assertEqual(gate.enter("write", time.time() + 0.05), "deadline") # the free slot is the waiting read's
+        gate.leave("read")
+        thread.join(5)
+        self.assertEqual(result, [None])
+
+    def test_middleware_sheds_requests_that_queued_too_long_upstream(self):
+        started = time.time() - settings.ADMISSION_QUEUE_DEADLINE - 1
+        response = self.client.get("/static/missing.css", HTTP_X_REQUEST_START="t={:.3f}".format(started))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], str(settings.ADMISSION_RETRY_AFTER))
+
+
+class ReportTests(CachedTestCase):
+    """Rating reports must not depend on how the reviews were chunked, and must leave out (but count) bad ratings."""
+
+    def test_histograms_merge_chunks_with_new_keys(self):
+        histograms = reports.Histograms()
+        histograms.add(np.array([3, 1, 3]), np.array([5, 1, 4]))
+        histograms.add(np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+        histograms.add(np.array([2, 3]), np.array([2, 2]))
+        self.assertEqual(histograms.keys.tolist(), [1, 2, 3])
+        self.assertEqual(histograms.counts.tolist(), [[0, 1, 0, 0, 0, 0], [0, 0, 1, 0, 0, 0], [0, 0, 1, 0, 1, 1]])
+
+    def test_summary_means_and_nearest_rank_percentiles(self):
+        histograms = reports.Histograms()
+        histograms.add(np.array([7] * 4), np.array([1, 2, 4, 5]))
+        row, = reports.summarize("month", histograms)
+        self.assertEqual((row["label"], row["reviews"], row["mean"]), ("1970-08", 4, 3.0))
+        self.assertEqual([row["p25"], row["p50"], row["p75"], row["p90"]], [1, 2, 4, 5])
+        self.assertEqual([row["rating_{}".format(rating)] for rating in range(1, 6)], [1, 1, 0, 1, 1])
+
+    def test_collect_covers_hot_and_archived_reviews_whatever_the_chunk_size(self):
+        bradbury = Author.objects.create(first_name="Ray", last_name="Bradbury")
+        le_guin = Author.objects.create(first_name="Ursula", last_name="Le Guin")
+        books = [Book.objects.create(title="Fahrenheit 451", author=bradbury), Book.objects.create(title="The Dispossessed", author=le_guin)]
+        user = User.objects.create(first_name="Ann", last_name="Reader", email="ann@example.com", password="x")
+        now = timezone.now()
+        for number, rating in enumerate([5, 4, 3, 2, 1, 5, 9]): # 9 is out of range
+            review = Review.objects.create(description="Review {}".format(number), rating=rating, user=user, book=books[number % 2])
+            Review.objects.filter(id=review.id).update(created_at=now - timedelta(days=40 * number))
+        archive.archive_reviews(now - timedelta(days=100)) # the older half goes cold
+
+        histograms, invalid = reports.collect(chunk_size=2)
+        self.assertEqual(invalid, 1)
+        rows = reports.summarize("author", histograms["author"])
+        self.assertEqual([(row["label"], row["reviews"], row["mean"]) for row in rows], [("Ray Bradbury", 3, 3.0), ("Ursula Le Guin", 3, 3.667)])
+        self.assertEqual(sum(row["reviews"] for row in reports.summarize("month", histograms["month"])), 6)
+        self.assertEqual(reports.summarize("cohort", histograms["cohort"])[0]["reviews"], 6)
+
+        whole, whole_invalid = reports.collect(chunk_size=1000)
+        self.assertEqual(whole_invalid, invalid)
+        for grouping in reports.GROUPINGS:
+            self.assertEqual(whole[grouping].keys.tolist(), histograms[grouping].keys.tolist())
+            self.assertEqual(whole[grouping].counts.tolist(), histograms[grouping].counts.tolist())
@@ -0,0 +1,116 @@
+"""
+Book title normalization, trigram similarity and duplicate merging.
+
+"The Shining", "the shining " and "Shining, The" all normalize to the same
+title key ("shining"), which `Book` stores in `title_key` and keeps unique per
+author. Near misses ("The Shinning") are caught with trigram similarity through
+the `BookTrigram` index (see `BookManager.suggest()`).
+
+Nothing here imports the models; callers pass them in. Migrations keep their own
+frozen copies of these rules (see `0005_book_title_keys`).
+"""
+
+from __future__ import unicode_literals
+
+import math
+import re
+import unicodedata
+
+from django.db import transaction
+
+ARTICLES = ("the", "a", "an") # Leading (or ", The"-style trailing) articles ignored in keys
+NON_ALPHANUMERIC_RE = re.compile(r"[\W_]+", re.U)
+TRAILING_ARTICLE_RE = re.compile(r",\s*(?:{})\s*$".format("|".join(ARTICLES)), re.I | re.U)
+
+
+def normalize_title(title):
+    """
+    Returns the duplicate-detection key for a book title.
+
+    Lowercases, strips accents, turns punctuation and runs of whitespace into a
+    single space and drops a leading article (or a trailing ", The").
+    """
+
+    title = unicodedata.normalize("NFKD", "{}".format(title))
+    title = "".join(char for char in title if not unicodedata.combining(char))
+    title = TRAILING_ARTICLE_RE.sub("", title).lower()
+    words = NON_ALPHANUMERIC_RE.sub(" ", title).split()
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+    return " ".join(words)
+
+
+def trigrams(key):
+    """Returns the set of 3-character grams of a title key, padded so short titles still match."""
+
+    padded = "  {} ".format(key)
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def similarity(key_a, key_b):
+    """Jaccard similarity of two title keys' trigram sets (0 to 1)."""
+
+    grams_a, grams_b = trigrams(key_a), trigrams(key_b)
+    if not grams_a or not grams_b:
+        return 0.0
+    return float(len(grams_a & grams_b)) / len(grams_a | grams_b)
+
+
+def _log_add(a, b):
+    """Adds two log-space trending scores (see `leaderboard.py`); None means empty."""
+
+    if a is None or b is None:
+        return b if a is None else a
+    high = max(a, b)
+    return high + math.log(math.exp(a - high) + math.exp(b - high))
+
+
+def find_duplicate_books(book_model):
+    """
+    Groups books by author and freshly computed title key (so stored keys written
+    under older normalization rules don't hide duplicates).
+
+    Returns a list of `(kept_book_id, [duplicate_book_ids])`; the oldest book is kept.
+    """
+
+    groups = {}
+    for book_id, author_id, title in book_model.objects.values_list("id", "author_id", "title").order_by("id").iterator():
+        groups.setdefault((author_id, normalize_title(title)), []).append(book_id)
+    return sorted((ids[0], ids[1:]) for ids in groups.values() if len(ids) > 1)
+
+
+def merge_duplicate_books(book_model, review_model, score_model=None, archive_model=None, dry_run=False):
+    """
+    Merges books sharing an author and title key into the oldest one.
+
+    Reviews (archived ones too) are moved onto the kept book and per-book leaderboard counters are
+    folded into its counters; the duplicates are then deleted (their trigram
+    and recommendation rows go with them).
+
+    Parameters:
+    - `book_model`, `review_model` - `Book` and `Review`.
+    - `score_model` - `BookScore`, if it exists yet.
+    - `archive_model` - `ArchivedReview`, if it exists yet.
+    - `dry_run` - Only report what would be merged.
+
+    Returns a list of `(kept_book_id, [merged_book_ids])`.
+    """
+
+    merged = find_duplicate_books(book_model)
+    if dry_run:
+        return merged
+    for kept_id, duplicate_ids in merged:
+        with transaction.atomic():
+            review_model.objects.filter(book_id__in=duplicate_ids).update(book_id=kept_id)
+            if archive_model is not None:
+                archive_model.objects.filter(book_id__in=duplicate_ids).update(book_id=kept_id)
+            if score_model is not None:
+                scores = list(score_model.objects.filter(book_id__in=duplicate_ids + [kept_id]))
+                if scores:
+                    score_model.objects.update_or_create(book_id=kept_id, defaults={
+                        "review_count": sum(score.review_count for score in scores),
+                        "rating_sum": sum(score.rating_sum for score in scores),
+                        "trending_score": reduce(_log_add, [score.trending_score for score in scores], None),
+                    })
+            book_model.objects.filter(id__in=duplicate_ids).delete()
+    return merged
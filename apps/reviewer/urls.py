@@ -11,5 +11,10 @@ urlpatterns = [
     url(r'^books/add$', views.add_review), # show add book review form, or add a book review
     url(r'^books/(?P<id>\d*)$', views.book), # show book and reviews, or create new book
     url(r'^users/(?P<id>\d*)$', views.user), # show user and reviews
+    url(r'^authors/(?P<id>\d+)$', views.author), # show author and their books
+    url(r'^users/(?P<id>\d+)/follow$', views.follow), # follow a reviewer
+    url(r'^users/(?P<id>\d+)/unfollow$', views.unfollow), # unfollow a reviewer
     url(r'^delete/(?P<id>\d*)$', views.destroy_review), # destroy a review
+    url(r'^metrics$', views.metrics_export), # per-view latency histograms for the local scraper
+    url(r'^api/reviews/batch$', views.api_reviews_batch), # partner integrations post many reviews at once
 ]
@@ -1,7 +1,24 @@
 from django.shortcuts import render, redirect
-from models import User, Author, Book, Review # gives us access to django models
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotModified, JsonResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from django.views.static import was_modified_since
+import gzip
+import json
+import mimetypes
+import os
+from models import User, Author, AuthorStats, Book, Review, BookNeighbor, Follow, ApiToken # gives us access to django models
+from django.db.models import Case, ExpressionWrapper, F, FloatField, IntegerField, When
+from django.db.models.functions import Coalesce
 from django.contrib import messages # grabs django's `messages` module
 from . import helper # grab custom dashboard helper module
+from . import metrics # per-view request histograms
+from . import archive # hot/cold review partitions
+from . import snapshots # pre-rendered public book pages
 
 # Add extra message levels to default messaging to handle login or registration error generation:
 # https://docs.djangoproject.com/en/1.11/ref/contrib/messages/#creating-custom-message-levels
@@ -9,6 +26,18 @@ LOGIN_ERR = 50 # Messages level for login errors
 REG_ERR = 60 # Messages level for registration errors
 REV_ERR = 70 # Messages level for book review errors
 LOGOUT_SUCC = 80 # Messages level for logout success messages
+FOLLOW_ERR = 90 # Messages level for follow errors
+
+AUTHOR_PAGE_SIZE = 20 # Books per author page
+# Author page sort options -> ordering (`review_count`, `average_rating` and `unrated` are annotated from `BookScore` in `author()`):
+AUTHOR_SORTS = {
+    "rating": ["unrated", "-average_rating", "title_key"], # unrated books last, on every database
+    "reviews": ["-review_count", "title_key"],
+    "title": ["title_key", "id"],
+    "newest": ["-created_at", "-id"],
+}
+
+API_BATCH_LIMIT = 250 # Most reviews accepted per batch request (keeps lookups under SQLite's variable limit)
 
 
 def index(request):
@@ -155,6 +184,7 @@ def add_review(request):
             "add_author": request.POST["add_author"],
             "description": request.POST["description"],
             "rating": request.POST["rating"],
+            "confirm_new_book": request.POST.get("confirm_new_book", ""), # skips "did you mean..." suggestions
             "user_id": request.session["user_id"], # current session user
         }
         validated = Review.objects.validate(**review_data)
@@ -191,14 +221,29 @@ def add_review(request):
 
 
 def book(request, id):
-    """If GET, shows book and all reviews; If POST, create additional review for book."""
+    """If GET, shows book and a page of its reviews; If POST, create additional review for book."""
+
+    # Reviews are paged newest first; older pages continue into the archive (see `./archive.py`):
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+    except ValueError:
+        page = 1
 
+    # Logged-out visitors and crawlers get the public page:
+    if "user_id" not in request.session:
+        if request.method == "POST":
+            messages.add_message(request, LOGIN_ERR, "You must be logged in to add a review.", extra_tags="login_errors")
+            return redirect("/")
+        return public_book(request, id, page)
 
-    book_data = {
-        "book": Book.objects.get(id=id),
-        "all_reviews": Review.objects.filter(book__id=id).order_by("-created_at"),
+    # Book, reviews and recommendations are shared by every logged-in user, and cached (see `helper.book_page_data()`):
+    book_data = helper.book_page_data(id, page)
+    book_data.update({
+        "page": page,
+        "previous_page": page - 1 if page > 1 else None,
+        "next_page": page + 1 if book_data["has_next"] else None,
         "user_id": request.session["user_id"], # for deleting your own reviews
-    }
+    })
 
     # If POST, create new book review:
     if request.method == "POST":
@@ -234,28 +279,239 @@ def book(request, id):
             return redirect("/books/" + str(validated.book.id))
     # If GET, load book page with book/review data:
     else:
-        helper.make_stars(book_data["all_reviews"])
         # Load show book page with book/review data:
         return render(request, "reviewer/show_book.html", book_data)
 
+def public_book(request, id, page):
+    """Shows a book to logged-out visitors; its first page is served from a pre-rendered snapshot (see `./snapshots.py`)."""
+
+    if page == 1:
+        path = snapshots.snapshot_path(id)
+        # Render on first visit; afterwards the workers keep it fresh:
+        if not os.path.isfile(path) and not snapshots.write(id):
+            raise Http404("Book not found.")
+        return snapshot_response(request, id, path)
+
+    book = Book.objects.select_related("author").filter(id=id).first()
+    if book is None:
+        raise Http404("Book not found.")
+    reviews, has_next = archive.reviews_page(page, book_id=id)
+    helper.make_stars(reviews)
+    return render(request, "reviewer/public_book.html", {
+        "book": book,
+        "all_reviews": reviews,
+        "previous_page": page - 1 if page > 1 else None,
+        "next_page": page + 1 if has_next else None,
+        "recommended_books": BookNeighbor.objects.filter(book__id=id).select_related("neighbor"),
+    })
+
+def snapshot_response(request, id, path):
+    """
+    Sends a gzip-compressed book snapshot.
+
+    With `settings.SNAPSHOT_ACCEL_PREFIX` set, the file itself is sent by the
+    front server (`X-Accel-Redirect`). Clients that don't accept gzip get it
+    decompressed.
+    """
+
+    modified = os.stat(path).st_mtime
+    if not was_modified_since(request.META.get("HTTP_IF_MODIFIED_SINCE"), modified):
+        return HttpResponseNotModified()
+
+    if "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", ""):
+        if settings.SNAPSHOT_ACCEL_PREFIX:
+            response = HttpResponse(content_type="text/html; charset=utf-8")
+            response["X-Accel-Redirect"] = snapshots.accel_path(id)
+        else:
+            response = FileResponse(open(path, "rb"), content_type="text/html; charset=utf-8")
+            response["Content-Length"] = os.path.getsize(path)
+        response["Content-Encoding"] = "gzip"
+    else:
+        with gzip.open(path, "rb") as snapshot:
+            response = HttpResponse(snapshot.read(), content_type="text/html; charset=utf-8")
+    response["Last-Modified"] = http_date(modified)
+    response["Vary"] = "Accept-Encoding, Cookie" # logged-in visitors get a different page
+    response["Cache-Control"] = "public, max-age=60"
+    return response
+
 def user(request, id):
     """Show user and user reviews."""
 
     # Get user data by id:
     user = {
         "user": User.objects.get(id=id),
-        "total_reviews": User.objects.get(id=id).review_set.all().count(),
-        "reviewed_books": Book.objects.filter(review__user__id=id).distinct(),
+        "total_reviews": archive.count_reviews(user_id=id), # hot and archived reviews
+        "reviewed_books": archive.reviewed_books(user_id=id),
+        "total_followers": Follow.objects.filter(followee__id=id).count(),
+        "current_user_id": request.session.get("user_id"), # hides the follow button on your own page
+        "following": Follow.objects.filter(follower__id=request.session.get("user_id"), followee__id=id).exists(),
     }
 
     return render(request, "reviewer/show_user.html", user)
 
+def author(request, id):
+    """
+    Shows an author and their books with review counts and average ratings.
+
+    Sortable (`?sort=rating|reviews|title|newest`) and paginated (`?page=N`).
+    Totals come from the author's `AuthorStats` row, so the page costs two
+    indexed queries: that row, and one page of books joined to `BookScore`.
+    """
+
+    # Get precomputed totals (authors without books have no row yet):
+    stats = AuthorStats.objects.select_related("author").filter(author_id=id).first()
+    if stats is None:
+        try:
+            stats = AuthorStats(author=Author.objects.get(id=id))
+        except Author.DoesNotExist:
+            raise Http404("Author not found.")
+
+    # Sort and page through the books:
+    sort = request.GET.get("sort", "rating")
+    if sort not in AUTHOR_SORTS:
+        sort = "rating"
+    pages = max((stats.book_count + AUTHOR_PAGE_SIZE - 1) // AUTHOR_PAGE_SIZE, 1)
+    try:
+        page = min(max(int(request.GET.get("page", 1)), 1), pages)
+    except ValueError:
+        page = 1
+    start = (page - 1) * AUTHOR_PAGE_SIZE
+    books = Book.objects.filter(author_id=id).annotate(
+        review_count=Coalesce(F("bookscore__review_count"), 0, output_field=IntegerField()),
+        average_rating=Case(
+            When(bookscore__review_count__gt=0, then=ExpressionWrapper(F("bookscore__rating_sum") * 1.0 / F("bookscore__review_count"), output_field=FloatField())),
+            default=None, output_field=FloatField(),
+        ),
+        unrated=Case(When(bookscore__review_count__gt=0, then=0), default=1, output_field=IntegerField()),
+    ).order_by(*AUTHOR_SORTS[sort])[start:start + AUTHOR_PAGE_SIZE]
+
+    author_data = {
+        "author": stats.author,
+        "stats": stats,
+        "books": books,
+        "sort": sort,
+        "sorts": sorted(AUTHOR_SORTS),
+        "page": page,
+        "pages": pages,
+        "previous_page": page - 1 if page > 1 else None,
+        "next_page": page + 1 if page < pages else None,
+    }
+    return render(request, "reviewer/show_author.html", author_data)
+
+def follow(request, id):
+    """Follows a reviewer, adding their reviews to the current user's dashboard feed."""
+
+    # Only follow on POST from a logged in user:
+    if request.method == "POST" and "user_id" in request.session:
+        followed = Follow.objects.follow(request.session["user_id"], id) # see `./models.py`, `follow()`
+        if isinstance(followed, dict):
+            print "User could not be followed."
+            for error in followed["errors"]:
+                messages.add_message(request, FOLLOW_ERR, error, extra_tags="follow_errors")
+    return redirect("/users/" + str(id))
+
+def unfollow(request, id):
+    """Unfollows a reviewer and removes their reviews from the current user's feed."""
+
+    # Only unfollow on POST from a logged in user:
+    if request.method == "POST" and "user_id" in request.session:
+        Follow.objects.unfollow(request.session["user_id"], id) # see `./models.py`, `unfollow()`
+    return redirect("/users/" + str(id))
+
 def destroy_review(request, id):
     """Destroys a review by ID from the database."""
 
-    # Get Book that review belongs to:
-    book = Book.objects.get(review__id=id)
-    # Delete review:
-    Review.objects.get(id=id).delete()
+    # Delete review and get Book that review belonged to:
+    book = Review.objects.destroy(id) # see `./models.py`, `destroy()`
     # Reload book view page:
     return redirect("/books/" + str(book.id))
+
+def static_asset(request, path):
+    """
+    Serves a collected static file, preferring its precompressed `.br`/`.gz` variant.
+
+    Only routed when `DEBUG` is off (see `django_book_reviewer/urls.py`); a front
+    server configured the same way can take over. Hashed file names never change
+    content, so they are marked `immutable` and repeat visits skip them entirely.
+    """
+
+    full_path = safe_join(settings.STATIC_ROOT, path) # rejects paths escaping STATIC_ROOT with a 400
+    if not os.path.isfile(full_path):
+        raise Http404("Static file not found.")
+
+    modified = os.stat(full_path).st_mtime
+    if not was_modified_since(request.META.get("HTTP_IF_MODIFIED_SINCE"), modified):
+        return HttpResponseNotModified()
+
+    # Pick the smallest variant the browser accepts:
+    accepted = request.META.get("HTTP_ACCEPT_ENCODING", "")
+    served_path, encoding = full_path, None
+    for variant, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if variant in accepted and os.path.isfile(full_path + suffix):
+            served_path, encoding = full_path + suffix, variant
+            break
+
+    response = FileResponse(open(served_path, "rb"), content_type=mimetypes.guess_type(full_path)[0] or "application/octet-stream")
+    response["Content-Length"] = os.path.getsize(served_path)
+    response["Last-Modified"] = http_date(modified)
+    response["Vary"] = "Accept-Encoding"
+    if encoding:
+        response["Content-Encoding"] = encoding
+    if path in _hashed_static_names():
+        response["Cache-Control"] = "public, max-age=31536000, immutable"
+    else:
+        response["Cache-Control"] = "public, max-age=60"
+    return response
+
+_hashed_names = None
+
+def _hashed_static_names():
+    """Returns the set of fingerprinted names from the static files manifest (loaded once)."""
+
+    global _hashed_names
+    if _hashed_names is None:
+        _hashed_names = set(getattr(staticfiles_storage, "hashed_files", {}).values())
+    return _hashed_names
+
+def metrics_export(request):
+    """Serves per-view request histograms in Prometheus text format, to allowed addresses only."""
+
+    if request.META.get("REMOTE_ADDR") not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden("Metrics are only available to the local scraper.")
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@csrf_exempt # authenticated by API token, not session cookie
+@require_POST
+def api_reviews_batch(request):
+    """
+    Creates many reviews from one JSON request, for partner integrations.
+
+    Expects `Authorization: Token <key>` (see `ApiToken`) and a body of
+    `{"reviews": [{"book_id": 3, "rating": 4, "description": "..."}, ...]}`
+    (or `"book"` and `"author"`/`"author_id"` instead of `"book_id"`). Valid
+    reviews are created even when others fail; the response lists one result
+    per review, in order (see `ReviewManager.add_reviews_batch()`).
+    """
+
+    # Authenticate partner:
+    scheme, _, key = request.META.get("HTTP_AUTHORIZATION", "").partition(" ")
+    token = ApiToken.objects.select_related("user").filter(key=key.strip()).first() if scheme == "Token" and key.strip() else None
+    if token is None:
+        return JsonResponse({"errors": ["A valid API token is required."]}, status=401)
+
+    # Parse batch:
+    try:
+        items = json.loads(request.body)["reviews"]
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({"errors": ['Body must be a JSON object with a "reviews" list.']}, status=400)
+    if not isinstance(items, list) or len(items) < 1:
+        return JsonResponse({"errors": ['"reviews" must be a non-empty list.']}, status=400)
+    if len(items) > API_BATCH_LIMIT:
+        return JsonResponse({"errors": ["At most {} reviews per request.".format(API_BATCH_LIMIT)]}, status=400)
+
+    results = Review.objects.add_reviews_batch(token.user, items) # see `./models.py`, `add_reviews_batch()`
+    return JsonResponse({
+        "created": sum(1 for result in results if "review_id" in result),
+        "failed": sum(1 for result in results if "errors" in result),
+        "results": results,
+    })
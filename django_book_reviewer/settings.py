@@ -37,10 +37,12 @@ INSTALLED_APPS = [
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
-    'django.contrib.staticfiles',
+    'apps.reviewer.apps.StaticFilesConfig', # `django.contrib.staticfiles` with extra ignore patterns
 ]
 
 MIDDLEWARE = [
+    'apps.reviewer.middleware.MetricsMiddleware', # first, so it times everything below it
+    'apps.reviewer.middleware.AdmissionMiddleware', # sheds load before any other work is done
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -48,6 +50,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'apps.reviewer.middleware.ProfilingMiddleware', # after sessions, which it uses to recognise staff
 ]
 
 ROOT_URLCONF = 'django_book_reviewer.urls'
@@ -71,6 +74,53 @@ TEMPLATES = [
 WSGI_APPLICATION = 'django_book_reviewer.wsgi.application'
 
 
+# Request metrics (see `apps/reviewer/metrics.py`)
+# Each worker thread writes its own memory-mapped file here; `/metrics` sums them.
+
+METRICS_DIR = os.path.join(BASE_DIR, 'var', 'metrics')
+
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1'] # addresses allowed to scrape `/metrics`
+
+
+# On-demand profiling (see `apps/reviewer/profiling.py`)
+# Staff trigger it with an `X-Profile` header or `?profile=` flag; `manage.py profile_report` summarizes dumps.
+
+PROFILING_DIR = os.path.join(BASE_DIR, 'var', 'profiles')
+
+PROFILING_STAFF_USER_IDS = [] # `User` ids allowed to request profiles
+
+PROFILING_SAMPLE_RATE = 0 # profile 1 in N requests; 0 turns sampling off
+
+PROFILING_MODE = 'sampler' # 'sampler' (low overhead) or 'cprofile' (exact)
+
+PROFILING_SAMPLE_INTERVAL = 0.005 # seconds between stack samples
+
+PROFILING_MAX_FILES = 200 # newest dumps kept
+
+
+# Admission control (see `apps/reviewer/admission.py`)
+# Per worker process. Reads may always use the slots auth and write requests can't reach.
+# The limits only matter with threaded workers; single-threaded workers (`serve_prefork`) only apply the deadline.
+
+ADMISSION_MAX_IN_FLIGHT = 16 # requests running at once
+
+ADMISSION_LIMITS = {'auth': 2, 'write': 4, 'read': 16} # requests running at once, per route class
+
+ADMISSION_MAX_WAITING = 32 # requests of one class waiting before the rest are shed immediately
+
+ADMISSION_QUEUE_DEADLINE = 2.0 # seconds a request may wait (from `X-Request-Start` if the front server sends it)
+
+ADMISSION_RETRY_AFTER = 5 # seconds, sent with the 503
+
+
+# Book page snapshots for logged-out visitors (see `apps/reviewer/snapshots.py`)
+# Regenerated by `run_workers` after review writes; `manage.py build_snapshots` rebuilds them all on deploy.
+
+SNAPSHOT_DIR = os.path.join(BASE_DIR, 'var', 'snapshots')
+
+SNAPSHOT_ACCEL_PREFIX = None # e.g. '/_snapshots/' to hand files to nginx with X-Accel-Redirect
+
+
 # Database
 # https://docs.djangoproject.com/en/1.10/ref/settings/#databases
 
@@ -82,6 +132,28 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/1.10/topics/cache/
+# Shared by every process -- server workers, job workers and management commands
+# -- for the primary-key cache (`apps/reviewer/pkcache.py`) and single-flight
+# page data, leases and invalidations (`apps/reviewer/singleflight.py`), so it
+# must live outside them: run memcached next to the app, with enough memory
+# (`memcached -m`) that rows aren't evicted long before `pkcache.SHARED_TTL`.
+# Never use the per-process `LocMemCache` here (`serve_prefork` refuses to
+# start on it). Without memcached, the database cache still carries
+# invalidations -- rows and page data then stay in each process's own memory:
+# 'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'django_book_reviewer_cache',
+# 'OPTIONS': {'MAX_ENTRIES': 10000},
+# (and run `python manage.py createcachetable` once per database).
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': '127.0.0.1:11211',
+    }
+}
+
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
@@ -120,3 +192,9 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.10/howto/static-files/
 
 STATIC_URL = '/static/'
+
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+
+# Hashed, minified and precompressed (.gz/.br) files -- see `apps/reviewer/storage.py`.
+# With DEBUG off, run `python manage.py collectstatic` on every deploy.
+STATICFILES_STORAGE = 'apps.reviewer.storage.CompressedManifestStaticFilesStorage'
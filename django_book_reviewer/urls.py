@@ -1,6 +1,15 @@
 """Sets up URL configurations for each application belonging to this project."""
+from django.conf import settings
 from django.conf.urls import url, include
+from apps.reviewer import views
 
 urlpatterns = [
     url(r'^', include("apps.reviewer.urls")),
 ]
+
+# In development `runserver` serves static files itself; otherwise serve the
+# hashed, precompressed output of `collectstatic` with far-future caching:
+if not settings.DEBUG:
+    urlpatterns += [
+        url(r'^static/(?P<path>.+)$', views.static_asset),
+    ]